@@ -0,0 +1,181 @@
+# This module runs measurements on several boards at the same time
+# Each board has its own MicroController.Session and the calls to the boards are made from a pool of threads,
+# the VISA / serial calls spend their time waiting on the USB link so the boards work in parallel
+# and the total time is set by the slowest board rather than the sum over all of them
+# The results from all the boards are merged into one stream of records ordered by time
+#   with Acquisition.Manager() as mgr:
+#       for rec in mgr.acquire('read_channels'):
+#           print(rec['time'], rec['address'], rec['data'])
+
+MOD_NAME_STR = "Acquisition"
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyvisa
+except ImportError:
+    pyvisa = None # only needed when no resource manager is given
+
+import MicroController
+
+class Manager(object):
+    # Opens a Session on every matching device and sends the same request to all of them in parallel
+
+    def __init__(self, addresses = None, rm = None, match = None, timeout = MicroController.READ_TIMEOUT):
+        # addresses is the list of devices to use, all devices found are used if none is given
+        # match, e.g. 'ASRL' or 'USB', keeps only the devices whose address contains it
+
+        FUNC_NAME = ".Manager.__init__()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        self.sessions = {}
+        self.pool = None
+        try:
+            if rm is None and pyvisa is None:
+                ERR_STATEMENT = ERR_STATEMENT + "\npyvisa is needed to find the devices, pip install pyvisa, or pass in rm"
+                raise Exception
+            self.rm = rm if rm is not None else pyvisa.ResourceManager()
+            if addresses is None:
+                addresses = self.rm.list_resources()
+            if match is not None:
+                addresses = [a for a in addresses if match in a]
+            if addresses:
+                self.pool = ThreadPoolExecutor(max_workers = len(addresses))
+                # open the devices in parallel as well, each one takes a while to come up
+                opened = self.pool.map(lambda a: MicroController.Session(a, timeout, rm = self.rm), addresses)
+                for address, dev in zip(addresses, opened):
+                    if dev.is_open():
+                        self.sessions[address] = dev
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNo devices connected"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def addresses(self):
+        return list(self.sessions.keys())
+
+    def run(self, method, *args, **kwargs):
+        # call the Session method named method with the given arguments on every board at once
+        # returns a dictionary of results keyed by address
+        futures = dict((a, self.pool.submit(getattr(dev, method), *args, **kwargs)) for a, dev in self.sessions.items())
+        return dict((a, f.result()) for a, f in futures.items())
+
+    def acquire(self, method, *args, **kwargs):
+        # as run, but returns one list of records ordered by the time each board's result came back
+        # each record is a dictionary with the time, the address of the board and the data
+
+        def timed(address, dev):
+            data = getattr(dev, method)(*args, **kwargs)
+            return {'time':time.time(), 'address':address, 'data':data}
+
+        futures = [self.pool.submit(timed, a, dev) for a, dev in self.sessions.items()]
+        return sorted((f.result() for f in futures), key = lambda rec: rec['time'])
+
+    def read_channels(self):
+        # voltages at Vin1 .. Vin5 on every board, as time ordered records
+        return self.acquire('read_channels')
+
+    def sweep(self, start, stop, step, settle = 0.01, n_reads = 1, mask = MicroController.ALL_CHANNELS):
+        # the same voltage sweep run on every board at once, as time ordered records
+        return self.acquire('sweep', start, stop, step, settle, n_reads, mask)
+
+    def stream(self, n_samples = 256, mask = (1 << 1), n_blocks = None):
+        # generator that merges the streamed blocks from every board, needs Measurement.AC_Read on the boards
+        # yields records with the time the block arrived, the address of the board and the block of raw counts
+        # runs for n_blocks blocks per board, or until the generator is closed if n_blocks is None
+        records = queue.Queue(maxsize = 16 * max(1, len(self.sessions)))
+        stop = threading.Event()
+
+        def pump(address, dev):
+            blocks = dev.stream(n_samples, mask, n_blocks)
+            try:
+                for counts in blocks:
+                    records.put({'time':time.time(), 'address':address, 'data':counts})
+                    if stop.is_set():
+                        break
+            finally:
+                blocks.close()
+                records.put(None) # this board is finished
+
+        futures = [self.pool.submit(pump, a, dev) for a, dev in self.sessions.items()]
+        try:
+            n_running = len(futures)
+            while n_running > 0:
+                rec = records.get()
+                if rec is None:
+                    n_running = n_running - 1
+                else:
+                    yield rec
+        finally:
+            stop.set()
+            # keep the queue moving until every board has stopped
+            while any(not f.done() for f in futures):
+                try:
+                    records.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        # close all the boards
+        for dev in self.sessions.values():
+            dev.close()
+        self.sessions = {}
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def Manager_Test(n_devices = 4, n_points = 5, settle = 0.1):
+    # Run a sweep on several simulated boards at once and compare the time taken with running them one after the other
+    # then stream a few blocks from each of them through the merged stream
+    # with settle seconds per point the parallel run should take about as long as one board on its own
+    # asserts that every board answered, that every streamed block arrived and that the parallel run was faster
+
+    FUNC_NAME = ".Manager_Test()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        import Simulator
+        with Manager(rm = Simulator.ResourceManager(n_devices)) as mgr:
+            if len(mgr.addresses()) == n_devices:
+                stop = 0.1 * (n_points - 1)
+
+                start_time = time.perf_counter()
+                for dev in mgr.sessions.values():
+                    dev.sweep(0.0, stop, 0.1, settle)
+                serial_time = time.perf_counter() - start_time
+
+                start_time = time.perf_counter()
+                records = mgr.sweep(0.0, stop, 0.1, settle)
+                parallel_time = time.perf_counter() - start_time
+
+                print("Boards: %(v1)d, one after the other: %(v2)0.3f s, in parallel: %(v3)0.3f s"%{"v1":n_devices, "v2":serial_time, "v3":parallel_time})
+                print("Records from: ", [rec['address'] for rec in records])
+                assert sorted(rec['address'] for rec in records) == sorted(mgr.addresses()), "Not every board returned a record"
+                assert all(rec['data'] is not None for rec in records), "A board returned no sweep"
+                assert n_devices < 2 or parallel_time < 0.5 * serial_time, "The parallel run was not much faster than one board after another"
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nCould not open all the simulated boards"
+                raise Exception
+
+        # merged streaming needs AC_Read on the boards
+        n_blocks = 3
+        with Manager(rm = Simulator.ResourceManager(n_devices, iface = 'AC_Read')) as mgr:
+            blocks = [rec for rec in mgr.stream(n_samples = 64, n_blocks = n_blocks)]
+            print("Streamed blocks: %(v1)d of %(v2)d"%{"v1":len(blocks), "v2":n_blocks * n_devices})
+            assert len(blocks) == n_blocks * n_devices, "Blocks were lost from the merged stream"
+
+        return {'serial_s':serial_time, 'parallel_s':parallel_time, 'records':records, 'blocks':blocks}
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
@@ -0,0 +1,162 @@
+# This module measures how fast the link between MicroController on the PC and Measurement on the board is
+# It reports round-trip latency percentiles for write and read commands, sustained samples / second for bulk reads
+# and the host-side cost of parsing each sample
+# It runs against a real board or the simulated board in Simulator, and writes the results as JSON
+# so that firmware revisions, and the serial and VISA backends in Transport, can be compared
+#   Benchmark.Run_Benchmarks(simulate = True, label = 'fw-2026-10')
+#   Benchmark.Backend_Benchmark('COM5')
+
+MOD_NAME_STR = "Benchmark"
+
+import time
+import json
+import struct
+import platform
+import numpy
+
+import MicroController
+import Transport
+
+PERCENTILES = (50, 90, 99)
+
+def Summarise(times):
+    # summary statistics of a list of times in seconds, reported in milliseconds
+
+    t = 1000.0 * numpy.asarray(times)
+    summary = {'n':int(len(t)), 'min_ms':float(numpy.min(t)), 'mean_ms':float(numpy.mean(t)), 'max_ms':float(numpy.max(t))}
+    for p in PERCENTILES:
+        summary['p%(v1)d_ms'%{"v1":p}] = float(numpy.percentile(t, p))
+    return summary
+
+def Latency_Benchmark(dev, n_queries = 500):
+    # round-trip latency of a write (writeAngStrA) and a read (readAngStr) on an open Session
+
+    FUNC_NAME = ".Latency_Benchmark()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        write_times = []
+        read_times = []
+        for i in range(0, n_queries, 1):
+            start_time = time.perf_counter()
+            dev.set_voltage(MicroController.Vmax * (i % 10) / 10.0)
+            write_times.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            dev.read_channels()
+            read_times.append(time.perf_counter() - start_time)
+        return {'write':Summarise(write_times), 'read':Summarise(read_times)}
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Throughput_Benchmark(dev, n_samples = 800, mask = MicroController.ALL_CHANNELS, n_blocks = 50):
+    # sustained samples / second for bulk block reads (readBlockStr) on an open Session
+    # a sample is one raw count from one channel
+
+    FUNC_NAME = ".Throughput_Benchmark()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        n_counts = 0
+        block_times = []
+        start_time = time.perf_counter()
+        for i in range(0, n_blocks, 1):
+            block_start = time.perf_counter()
+            counts = dev.read_block(n_samples, mask)
+            block_times.append(time.perf_counter() - block_start)
+            n_counts = n_counts + counts.size
+        elapsed_time = time.perf_counter() - start_time
+        return {'samples':int(n_counts), 'elapsed_s':elapsed_time, 'samples_per_s':n_counts / elapsed_time,
+                'bytes_per_s':2.0 * n_counts / elapsed_time, 'block':Summarise(block_times)}
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Backend_Benchmark(address, backends = (Transport.SERIAL, Transport.VISA), n_queries = 200, n_blocks = 20, rm = None):
+    # latency and throughput of the same device reached over each of backends in turn, see Transport
+    # a backend that can not reach the device is reported as None
+
+    results = {}
+    for backend in backends:
+        with MicroController.Session(address, rm = rm, backend = backend) as dev:
+            if dev.is_open():
+                results[backend] = {'latency':Latency_Benchmark(dev, n_queries), 'throughput':Throughput_Benchmark(dev, n_blocks = n_blocks)}
+            else:
+                results[backend] = None
+    for backend, result in results.items():
+        if result is not None:
+            print("%(v1)s: read p50 %(v2)0.3f ms, bulk read %(v3)0.0f samples / s"%{"v1":backend, "v2":result['latency']['read']['p50_ms'],
+                                                                                  "v3":result['throughput']['samples_per_s']})
+    return results
+
+def Parse_Benchmark(n_samples = 10000, n_repeats = 20):
+    # host-side cost per sample of decoding a binary frame compared with parsing the text reply to readAngStr
+    # no device is needed, the frame and text are made up here
+
+    FUNC_NAME = ".Parse_Benchmark()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        n_channels = MicroController.N_CHANNELS
+        counts = numpy.random.randint(0, MicroController.bit_scale, size = n_samples * n_channels).astype('<u2')
+        header = struct.pack(MicroController.FRAME_HEADER, MicroController.frameStartStr, MicroController.ALL_CHANNELS, n_samples, 2 * counts.size)
+        payload = counts.tobytes()
+        lines = [' '.join(repr(v) for v in row) for row in MicroController.Counts_To_Volts(counts.reshape(n_samples, n_channels))]
+
+        start_time = time.perf_counter()
+        for i in range(0, n_repeats, 1):
+            MicroController.Counts_To_Volts(MicroController.Decode_Frame(header, payload))
+        frame_time = (time.perf_counter() - start_time) / (n_repeats * counts.size)
+
+        start_time = time.perf_counter()
+        for i in range(0, n_repeats, 1):
+            numpy.array([MicroController.Parse_Reading(line) for line in lines])
+        text_time = (time.perf_counter() - start_time) / (n_repeats * counts.size)
+
+        return {'frame_ns_per_sample':1.0e9 * frame_time, 'text_ns_per_sample':1.0e9 * text_time}
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Run_Benchmarks(simulate = False, address = None, label = '', out_file = 'benchmark.json', n_queries = 500, n_blocks = 50, backend = Transport.VISA):
+    # run all of the benchmarks against one device and write the results to out_file as JSON
+    # simulate = True runs against Simulator instead of a real board
+    # backend is the Transport backend used to reach the device
+    # label identifies the firmware revision, or anything else, in the results
+
+    FUNC_NAME = ".Run_Benchmarks()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        rm = None
+        if simulate:
+            import Simulator
+            rm = Simulator.ResourceManager()
+
+        results = {'label':label, 'simulated':simulate, 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'host':platform.node(),
+                   'python':platform.python_version()}
+        with MicroController.Session(address, rm = rm, backend = backend) as dev:
+            if dev.is_open():
+                results['address'] = dev.address
+                results['backend'] = dev.backend
+                results['latency'] = Latency_Benchmark(dev, n_queries)
+                results['throughput'] = Throughput_Benchmark(dev, n_blocks = n_blocks)
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nCould not open device"
+                raise Exception
+        results['parse'] = Parse_Benchmark()
+
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+        print("Write p50: %(v1)0.3f ms, p99: %(v2)0.3f ms"%{"v1":results['latency']['write']['p50_ms'], "v2":results['latency']['write']['p99_ms']})
+        print("Read p50: %(v1)0.3f ms, p99: %(v2)0.3f ms"%{"v1":results['latency']['read']['p50_ms'], "v2":results['latency']['read']['p99_ms']})
+        print("Bulk read: %(v1)0.0f samples / s"%{"v1":results['throughput']['samples_per_s']})
+        print("Parse cost: frame %(v1)0.1f ns / sample, text %(v2)0.1f ns / sample"%{"v1":results['parse']['frame_ns_per_sample'], "v2":results['parse']['text_ns_per_sample']})
+        print("Results written to", out_file)
+
+        return results
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
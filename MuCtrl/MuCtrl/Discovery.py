@@ -0,0 +1,164 @@
+# This module keeps track of which board is attached at which address
+# The VISA resources and serial ports are enumerated once, each board is asked what it is with the identify command,
+# over VISA where a VISA library is installed and over pyserial for the serial ports VISA does not cover, see Transport
+# and the answers are cached in memory and on disk, so later runs do not have to enumerate and probe everything again
+# A lookup that misses the cache, or finds a board that no longer answers as expected, triggers a fresh scan
+#   reg = Discovery.Registry()
+#   dev = reg.open(iface = 'Cuffe_Iface')
+
+MOD_NAME_STR = "Discovery"
+
+import os
+import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyvisa
+except ImportError:
+    pyvisa = None # serial ports are still scanned without it
+
+import MicroController
+import Transport
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.muctrl_devices.json') # where the registry is kept between runs
+PROBE_TIMEOUT = 500 # milliseconds to wait for a board to identify itself
+
+def Serial_Ports():
+    # the serial ports known to pyserial, keyed by device name, with the USB details that identify the physical board
+
+    try:
+        from serial.tools import list_ports
+        return dict((p.device, {'description':p.description, 'serial_number':p.serial_number, 'vid':p.vid, 'pid':p.pid})
+                    for p in list_ports.comports())
+    except ImportError:
+        return {}
+
+def Port_Of(address, ports):
+    # the serial port behind a VISA ASRL address, e.g. ASRL5::INSTR is COM5, ASRL/dev/ttyACM0::INSTR is /dev/ttyACM0
+
+    m = re.match(r'ASRL(\d+)::', address)
+    if m and 'COM' + m.group(1) in ports:
+        return 'COM' + m.group(1)
+    m = re.match(r'ASRL(.+)::', address)
+    if m and m.group(1) in ports:
+        return m.group(1)
+    return None
+
+class Registry(object):
+    # Cached map from device address to board identity
+
+    def __init__(self, rm = None, cache_file = CACHE_FILE, probe_timeout = PROBE_TIMEOUT):
+        # cache_file = None keeps the registry in memory only
+        # without pyvisa, or a VISA library for it to use, only the serial ports are scanned
+        self.rm = rm
+        if rm is None and pyvisa is not None:
+            try:
+                self.rm = pyvisa.ResourceManager()
+            except (ValueError, OSError):
+                self.rm = None # pyvisa could not find a VISA library
+        self.cache_file = cache_file
+        self.probe_timeout = probe_timeout
+        self.devices = {}
+        self.scan_time = None
+        self.load()
+
+    def load(self):
+        # read the cached registry from disk, if there is one
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as f:
+                    cache = json.load(f)
+                self.devices = cache.get('devices', {})
+                self.scan_time = cache.get('scan_time')
+            except (OSError, ValueError):
+                self.devices = {}
+
+    def save(self):
+        # write the registry to disk
+        if self.cache_file is not None:
+            with open(self.cache_file, 'w') as f:
+                json.dump({'scan_time':self.scan_time, 'devices':self.devices}, f, indent = 2)
+
+    def probe(self, address, backend = Transport.VISA):
+        # open a device briefly and ask it what it is, None if it does not answer
+        # only identifyStr is sent, query mode is left off, so other instruments on the bus only see a standard *IDN?
+        dev = MicroController.Session(address, self.probe_timeout, rm = self.rm if backend == Transport.VISA else None,
+                                      query_mode = False, backend = backend)
+        try:
+            return dev.identify() if dev.is_open() else None
+        finally:
+            dev.close()
+
+    def scan(self):
+        # enumerate the VISA resources and serial ports once and identify every device, in parallel
+        # a serial port that is also a VISA resource is only probed over VISA
+
+        FUNC_NAME = ".Registry.scan()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            resources = list(self.rm.list_resources()) if self.rm is not None else []
+            ports = Serial_Ports()
+            visa_ports = set(Port_Of(address, ports) for address in resources)
+            targets = [(address, Transport.VISA) for address in resources]
+            targets = targets + [(port, Transport.SERIAL) for port in ports if port not in visa_ports]
+            self.devices = {}
+            if targets:
+                with ThreadPoolExecutor(max_workers = len(targets)) as pool:
+                    identities = list(pool.map(lambda target: self.probe(*target), targets))
+                for (address, backend), idn in zip(targets, identities):
+                    port = address if backend == Transport.SERIAL else Port_Of(address, ports)
+                    self.devices[address] = {'identity':idn, 'backend':backend, 'port':port, 'usb':ports.get(port)}
+            self.scan_time = time.time()
+            self.save()
+            return self.devices
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def matches(self, address, **match):
+        # True if the cached identity of the device at address has all the fields given in match, e.g. board = 'itsybitsy_m4_express'
+        idn = self.devices.get(address, {}).get('identity')
+        return idn is not None and all(idn.get(k) == v for k, v in match.items())
+
+    def find(self, **match):
+        # addresses of the boards whose identity has all the fields in match, see IDN_FIELDS
+        # the devices are scanned again if nothing in the cache matches
+        found = [a for a in self.devices if self.matches(a, **match)]
+        if not found:
+            self.scan()
+            found = [a for a in self.devices if self.matches(a, **match)]
+        return found
+
+    def open(self, timeout = MicroController.READ_TIMEOUT, **match):
+        # open a Session on the first board that matches, the board is asked to identify itself again before it is used
+        # so a stale cache entry can not send a measurement to the wrong device
+        # the devices are scanned again at most once, if nothing in the cache can be opened
+
+        FUNC_NAME = ".Registry.open()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            for attempt in range(0, 2, 1):
+                if attempt > 0:
+                    self.scan() # the cache was out of date, look again
+                for address in [a for a in self.devices if self.matches(a, **match)]:
+                    backend = self.devices[address].get('backend', Transport.VISA)
+                    dev = MicroController.Session(address, timeout, rm = self.rm if backend == Transport.VISA else None, backend = backend)
+                    if dev.is_open():
+                        idn = dev.identify()
+                        if idn is not None and all(idn.get(k) == v for k, v in match.items()):
+                            return dev
+                    dev.close()
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo board matching " + str(match)
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def show(self):
+        # print the registry
+        for address, entry in self.devices.items():
+            print(address, ",", entry['identity'], ",", entry.get('backend', Transport.VISA), ",", entry['port'])
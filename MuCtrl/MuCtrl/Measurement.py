@@ -7,18 +7,31 @@ MOD_NAME_STR = "Measurement"
 # import the necessary modules
 import board
 import time
+import struct
+import array
+import gc
+import math
+import binascii # crc32 of checked replies
 import digitalio
 from analogio import AnalogOut
 from analogio import AnalogIn
 import supervisor # for listening to serial ports
+import usb_cdc # for writing raw bytes to the serial port
+import microcontroller # for the cpu temperature, used to spot calibration drift
 
 # Define the names of the pins being written to and listened to
 Vout = AnalogOut(board.A0)
+Vout.value = 0
+vout_code = 0 # last code written to Vout, AnalogOut.value can be written but not read back on CircuitPython, see set_output
 Vin1 = AnalogIn(board.A1)
 Vin2 = AnalogIn(board.A2)
 Vin3 = AnalogIn(board.A3)
 Vin4 = AnalogIn(board.A4)
 Vin5 = AnalogIn(board.A5)
+Vin_pins = (Vin1, Vin2, Vin3, Vin4, Vin5) # bit k of a channel mask selects Vin_pins[k]
+PIN_MAP = 'Vout=A0 Vin1=A1 Vin2=A2 Vin3=A3 Vin4=A4 Vin5=A5' # reported by the identify command
+
+FIRMWARE_VERSION = '2026.10.8' # change this whenever the command set changes
 
 # Define the names of the read / write commands
 readCmdStr = 'r'; # read data command string for reading max AC input
@@ -26,23 +39,153 @@ writeCmdStr = 'w'; # write data command string for writing frequency values
 writeAngStrA = 'a'; # write analog output from DCPINA
 writeAngStrB = 'b'; # write analog output from DCPINB
 readAngStr = 'l'; # read analog input
+readBlockStr = 'k'; # read a block of raw analog input counts as a binary frame, k<samples>,<channel mask>
+queryModeStr = 'q'; # q1 switches query mode on, q0 switches it off
+identifyStr = '*IDN?'; # identify the board, reply is MuCtrl,<board>,<firmware version>,<interface>,<pin map>
+captureCmdStr = 'c'; # capture raw counts into the preallocated buffer and send them as a binary frame, c<samples>,<channel mask>
+streamCmdStr = 'm'; # stream raw counts continuously as sequence numbered binary frames, m<samples per block>,<channel mask>,<rate Hz>, any command stops it
+rateCmdStr = 'f'; # capture at a fixed sample rate and report the timing, f<rate Hz>,<samples>,<channel mask>
+statsCmdStr = 'x'; # statistics of the raw counts over a window, x<window samples>,<channel mask>,<statistics mask>
+calCmdStr = 'z'; # zero offset calibration, z re-measures it, z? reports the cached values, z<max age> sets the max age in seconds
+sweepCmdStr = 's'; # sweep the analog output, s<start>,<stop>,<step>,<settle time>,<reads per point>,<channel mask>
+triggerCmdStr = 't'; # triggered capture, t<pre samples>,<post samples>,<channel mask>,<trigger channel>,<level V>,<edge>,<timeout s>
+oversampleCmdStr = 'n'; # oversampling of the read path, n<samples>,<extra bits> sets it, n? reports it, reply is <samples> <extra bits>
+encodeCmdStr = 'e'; # frame encoding, e0 sends raw counts, e1 sends delta / zigzag / varint compressed frames, e? reports it
+gcCaptureCmdStr = 'g'; # capture with the garbage collector off, g<samples>,<channel mask>, reply is a binary frame then the values in GC_REPORT
+currentCmdStr = 'i'; # constant current mode, i<target mA>,<kp>,<ki>,<tolerance mA>,<iterations per report>,<duration>, any command stops it
+
+# In query mode every reply, including the reply to a write, is closed by a line containing only replyEndStr
+# The host can then block until the terminator arrives instead of sleeping for a fixed time
+# Query mode is off by default so that LabVIEW sees the same replies as before
+replyEndStr = '$'
+query_mode = False
+
+# Checked replies
+# a command sent as !<seq>:<command> gets a reply that starts with a line containing only !<seq> and is closed by the line
+# $<seq> <crc> in place of replyEndStr, crc being the CRC-32 of every byte of the reply in between, text and binary frames alike
+# the host can then skip whatever is left over from earlier replies, and spot a reply that was cut short or corrupted and ask again
+seqStr = '!'
+checking = False # True while a checked command is running
+reply_crc = 0
+console_print = print # the built-in print, print below adds to the CRC of a checked reply
+
+def print(*args):
+    # print the values separated by spaces as the built-in print does, adding the line to the CRC while a checked command is running
+    global reply_crc
+    if checking:
+        line = ' '.join([str(a) for a in args]) + '\n'
+        reply_crc = binascii.crc32(line.encode('ascii'), reply_crc)
+        console_print(line, end = '')
+    else:
+        console_print(*args)
+
+def console_write(buf):
+    # write raw bytes to the serial port, adding them to the CRC while a checked command is running
+    global reply_crc
+    if checking:
+        reply_crc = binascii.crc32(buf, reply_crc)
+    usb_cdc.console.write(buf)
+
+# Several commands can be sent on one line separated by batchSepStr, they are run in order and each one is answered in turn
+batchSepStr = ';'
+
+# Define the layout of the binary frame sent in reply to readBlockStr
+# start byte, channel mask, samples per channel, payload length in bytes, all little-endian
+# the payload is the raw 16-bit counts, interleaved in channel order
+frameStartStr = b'#'
+FRAME_HEADER = '<cBHI'
+ALL_CHANNELS = 0x1F # mask selecting Vin1 .. Vin5
+MAX_BLOCK = 4096 # max no. counts in a single frame, keeps the buffer well inside the available RAM
+# Compressed frames, sent in place of the frames above when frame_encoding is ENCODE_DELTA, see write_encoded_frame
+# start byte, channel mask, samples per channel, no. low bits dropped from every count, then the payload in chunks,
+# each a 2-byte length and that many bytes, a zero length ends the payload and is followed by a Fletcher-32 checksum of the counts
+# the payload holds each channel in turn, as the difference of each count from the previous one, zigzag coded so small
+# differences of either sign are small numbers, and written as varints of 7 bits per byte; a zero is followed by
+# the length of a run of zero differences
+encodedStartStr = b'%'
+ENCODED_HEADER = '<cBHB'
+ENCODE_RAW = 0
+ENCODE_DELTA = 1
+ENCODE_CHUNK = 512 # payload bytes per chunk
+frame_encoding = ENCODE_RAW
+encode_buf = bytearray(ENCODE_CHUNK + 16) # room for the chunk length and one more run of varints past the chunk size
+# Streamed blocks use their own start byte and carry a sequence number so the host can detect gaps
+# start byte, channel mask, samples per channel, payload length in bytes, block sequence number,
+# time of the first sample in the block in microseconds on the time.monotonic_ns() clock, wrapping at 32 bits
+streamStartStr = b'@'
+STREAM_HEADER = '<cBHIII'
+STREAM_CHUNKS = 8 # no. pieces each streamed block is sent in, sampling of the next block carries on between pieces
+US_WRAP = 0xFFFFFFFF # block timestamps are sent modulo 2^32 microseconds, ~71 minutes
+
+# Timing of paced sampling, see sample_paced, the reply to rateCmdStr is a line with
+# requested rate, achieved rate, mean / rms / max lateness of the samples in microseconds, no. samples late by a whole period
+TIMING = ('rate', 'achieved', 'mean_us', 'rms_us', 'max_us', 'late')
+
+# Report of a capture made with the garbage collector off, see gc_capture
+# achieved rows / s, largest step between rows in ms, no. steps of STALL_MS or more, free heap in bytes when sampling started
+# and bytes allocated while sampling, which should be 0
+GC_REPORT = ('achieved', 'max_gap_ms', 'stalls', 'mem_free', 'alloc')
+TICKS_MASK = (1 << 29) - 1 # supervisor.ticks_ms wraps at 2^29
+STALL_MS = 2 # rows normally follow each other in well under 1 ms, a step this long means the loop was held up
+gc_stats = [0, 0] # largest step between rows and no. stalls, filled in by sample_gc_free without allocating
+# Statistics computed by statsCmdStr, bit k of the statistics mask selects STATS[k]
+# the reply is one line with the selected statistics for each channel in turn, in volts except for the sample count
+STATS = ('min', 'max', 'mean', 'rms', 'p2p', 'n')
+ALL_STATS = 0x3F
+ADC_SHIFT = 4 # the SAMD51 ADC is 12-bit, AnalogIn.value scales it up to 16 bits by this many bits
+STATS_BLOCK = 32 # no. squared 12-bit counts that can be summed before the total leaves the small int range
+OVERSAMPLE_MAX = 4096 # max samples averaged per reading, the 12-bit accumulator stays a small int
+MAX_FRAME_SAMPLES = 65535 # max samples per channel that fit in the frame header
+TRIGGER_CHECK = 256 # samples between checks of the timeout while waiting for a trigger
+CAPTURE_RESERVE = 16*1024 # bytes of RAM left free when the capture buffer is sized, for the interpreter and serial I/O
 
 # Define the constants
 Vmax = 3.3 # max AO/AI value
 bit_scale = (64*1024) # 64 bits
+Vscale = (5.0/3.0) # voltage-divider scaling on the inputs Vin2 .. Vin5
+
+# Cached calibration, per-channel zero offsets and divider gains for Vin1 .. Vin5
+# it is re-measured only on request, once it is older than max_age seconds, or when drift is detected,
+# see get_calibration
+CAL_MAX_AGE = 600.0 # seconds
+CAL_DRIFT_V = 0.005 # change in the zero reading at A1 that counts as drift, in volts
+CAL_DRIFT_T = 2.0 # change in cpu temperature that counts as drift, in degrees C
+calibration = {'offset':[0.0, 0.0, 0.0, 0.0, 0.0], 'gain':[1.0, Vscale, Vscale, Vscale, Vscale],
+               'time':None, 'temperature':None, 'max_age':CAL_MAX_AGE}
+
+# Define the current source circuit, resistances in kOhm so currents are in mA
+# with Vout at Vset the current through R3 is about Vset * R2 / (R1 * R3), i.e. ~39 mA per V
+R1 = (54.9/1000.0)
+R2 = (10.3/1000.0)
+R3 = (4.8/1000.0)
+
+# Define the defaults for the constant current mode, see regulate_current
+CC_KP = 0.005 # proportional gain in V / mA
+CC_KI = 2.0 # integral gain in V / (mA s)
+CC_TOL = 0.5 # mA, about two 12-bit counts of IR3
+CC_SETTLE_COUNT = 20 # iterations in a row within the tolerance before the current counts as settled
+CC_REPORT = 100 # iterations per report line
 
 # Need the following functions to convert voltages to 12-bit readings
 # which can be understood by the board
 
-def dac_value(volts):
-    # convert a voltage to 10-bit value
+# The scale factors are checked and computed once, when the module is loaded, see set_scale
+# so the conversions below are a single multiplication with no checks or exception handling per call
+volts_per_count = 0.0
+counts_per_volt = 0.0
+
+def set_scale():
+    # check the volt and bit scale factors and compute the conversion factors from them
 
-    FUNC_NAME = ".dac_value()" # use this in exception handling messages
+    global volts_per_count, counts_per_volt
+
+    FUNC_NAME = ".set_scale()" # use this in exception handling messages
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
         if Vmax > 0.0 and bit_scale > 0:
-            return int((volts / Vmax)*bit_scale)
+            volts_per_count = Vmax / bit_scale
+            counts_per_volt = bit_scale / Vmax
         else:
             ERR_STATEMENT = ERR_STATEMENT + "\nvolt, bit scale factors not defined"
             raise Exception
@@ -50,23 +193,65 @@ def dac_value(volts):
         print(ERR_STATEMENT)
         print(e)
 
+set_scale()
+
+# Oversampling of the read path, see set_oversampling
+# each reading on readAngStr and readBlockStr is the average of oversample_n samples, accumulated as 12-bit integers
+# and decimated to 12 + oversample_bits significant bits of the 16-bit count
+oversample_n = 1
+oversample_bits = 0
+
+def set_oversampling(n_samples, bits = -1):
+    # average n_samples samples per reading, with bits extra bits of resolution kept from the average
+    # bits = -1 takes the bits that oversampling by n_samples supports, one for each factor of 4, up to ADC_SHIFT
+
+    global oversample_n, oversample_bits
+
+    if n_samples < 1 or n_samples > OVERSAMPLE_MAX:
+        raise ValueError('Oversampling must be in the range [1, %(v1)d]'%{"v1":OVERSAMPLE_MAX})
+    if bits < 0:
+        bits = 0
+        while bits < ADC_SHIFT and (4 << (2 * bits)) <= n_samples:
+            bits = bits + 1
+    elif bits > ADC_SHIFT:
+        raise ValueError('Extra bits must be in the range [0, %(v1)d]'%{"v1":ADC_SHIFT})
+    oversample_n = n_samples
+    oversample_bits = bits
+
+def read_count(pin):
+    # raw 16-bit count from pin averaged over oversample_n samples, the sum is kept as an integer of 12-bit counts
+    # and the average is decimated to 12 + oversample_bits bits before it is scaled back up to 16 bits
+    acc = 0
+    for n in range(0, oversample_n, 1):
+        acc = acc + (pin.value >> ADC_SHIFT)
+    return ((acc << oversample_bits) // oversample_n) << (ADC_SHIFT - oversample_bits)
+
+def dac_value(volts):
+    # convert a voltage to 10-bit value
+    return int(volts * counts_per_volt)
+
+def set_output(code):
+    # write code to the DAC at Vout and keep it in vout_code so it can be restored or checked later
+    global vout_code
+    Vout.value = code
+    vout_code = code
+
 def get_voltage(pin, offset = 0.0):
     # convert pin reading to voltage value
     # correct voltage by substracting offset
-    
-    FUNC_NAME = ".get_voltage()" # use this in exception handling messages
-    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+    ret_val = (pin.value if oversample_n == 1 else read_count(pin)) * volts_per_count
+    return ret_val - offset if offset > 0.0 else ret_val
 
-    try:
-        if Vmax > 0.0 and bit_scale > 0:
-            ret_val = ((pin.value*Vmax)/bit_scale)
-            return ret_val - offset if offset > 0.0 else ret_val
-        else:
-            ERR_STATEMENT = ERR_STATEMENT + "\nvolt, bit scale factors not defined"
-            raise Exception
-    except Exception as e:
-        print(ERR_STATEMENT)
-        print(e)
+def counts_to_volts(buf, n_counts, out):
+    # convert the first n_counts raw counts in buf to volts in the preallocated array out, which may be buf itself
+    # e.g. out = array.array('f', bytearray(4 * n_counts))
+    # the scale factor is the float volts_per_count rather than an integer factor and shift, the M4 has a hardware FPU
+    # so a float multiply costs no more than the integer one and the result is already in volts
+
+    scale = volts_per_count
+    for i in range(0, n_counts, 1):
+        out[i] = buf[i] * scale
+    return out
 
 # Determine the zero offset using A0 and A1
 def get_zero_offset():
@@ -74,13 +259,636 @@ def get_zero_offset():
     # Ensure that Vout (A0) is set to zero
     # There is a bit of an offset in voltage between the Read and the Write, 
     # presumably because the pins are floating.
-    Vout.value = dac_value(0)
+    # The output is put back to whatever it was set to once the offset has been read
+    Vset = vout_code
+    set_output(dac_value(0))
     time.sleep(0.5)
     deltaV = get_voltage(Vin1, 0.0) # offset in the voltage reading at A2 O(10 mV)
     # print("deltaV Reading at A1: ", deltaV)
+    set_output(Vset)
 
     return deltaV;
 
+def measure_calibration():
+    # measure the zero offset and store it in the calibration cache along with the time and cpu temperature
+    # the offset at A1 is applied to all the channels, as in the measurement methods
+
+    deltaV = get_zero_offset()
+    for i in range(0, len(calibration['offset']), 1):
+        calibration['offset'][i] = deltaV
+    calibration['time'] = time.monotonic()
+    calibration['temperature'] = microcontroller.cpu.temperature
+    return calibration
+
+def calibration_drifted():
+    # cheap check on whether the cached calibration still holds, nothing is written to the output
+    # the cpu temperature is compared with its value at calibration
+    # and if the output happens to be at zero the reading at A1 is compared with the cached offset
+
+    if abs(microcontroller.cpu.temperature - calibration['temperature']) > CAL_DRIFT_T:
+        return True
+    if vout_code == 0 and abs(get_voltage(Vin1) - calibration['offset'][0]) > CAL_DRIFT_V:
+        return True
+    return False
+
+def get_calibration(refresh = False):
+    # return the cached calibration, measuring it first if asked to, if it has never been measured,
+    # if it is older than its max age or if it has drifted
+
+    if refresh or calibration['time'] is None or time.monotonic() - calibration['time'] > calibration['max_age'] or calibration_drifted():
+        measure_calibration()
+    return calibration
+
+def identify(iface):
+    # identification string for the board running the firmware method iface
+
+    return "MuCtrl,%(v1)s,%(v2)s,%(v3)s,%(v4)s"%{"v1":board.board_id, "v2":FIRMWARE_VERSION, "v3":iface, "v4":PIN_MAP}
+
+def get_channels(mask):
+    # convert a channel mask into the tuple of input pins to be read
+    # bit 0 selects Vin1, bit 1 selects Vin2, ..., bit 4 selects Vin5
+    # every mask sent with a command passes through here, so one outside [0, ALL_CHANNELS] is rejected here too,
+    # it would not fit in the mask byte of a frame header
+
+    if mask < 0 or mask > ALL_CHANNELS:
+        raise ValueError('Channel mask must be in the range [0, %(v1)d]'%{"v1":ALL_CHANNELS})
+
+    return tuple(Vin_pins[i] for i in range(0, len(Vin_pins), 1) if mask & (1 << i))
+
+def new_buffer(n_counts):
+    # allocate a zeroed array of n_counts 16-bit raw counts in one go
+    return array.array('H', bytearray(2 * n_counts))
+
+def capture_size(reserve = CAPTURE_RESERVE):
+    # no. of raw counts that can be held in a buffer sized to the free RAM
+    # building the array copies a zeroed bytearray of the same size, so room is left for two copies while it is made
+
+    gc.collect()
+    return max(0, (gc.mem_free() - reserve) // 4)
+
+def sample_channels(buf, n_samples, channels):
+    # fill buf with n_samples raw counts from each of the channels, interleaved in channel order
+    # nothing is allocated inside the sampling loop
+
+    if len(channels) == 1:
+        pin = channels[0]
+        for i in range(0, n_samples, 1):
+            buf[i] = pin.value
+    else:
+        i = 0
+        for n in range(0, n_samples, 1):
+            for pin in channels:
+                buf[i] = pin.value
+                i = i + 1
+
+def sample_gc_free(buf, n_samples, channels, stats):
+    # as sample_channels, also timing each row with supervisor.ticks_ms, a small int, so that nothing at all is allocated
+    # time.monotonic_ns would allocate a long int per row, which can not be allowed with the garbage collector off
+    # the largest step between rows in ms and the no. steps of STALL_MS or more are put in stats
+
+    ticks = supervisor.ticks_ms
+    max_gap = 0
+    n_stalls = 0
+    prev = ticks()
+    i = 0
+    for n in range(0, n_samples, 1):
+        for pin in channels:
+            buf[i] = pin.value
+            i = i + 1
+        now = ticks()
+        gap = (now - prev) & TICKS_MASK
+        if gap > max_gap:
+            max_gap = gap
+        if gap >= STALL_MS:
+            n_stalls = n_stalls + 1
+        prev = now
+    stats[0] = max_gap
+    stats[1] = n_stalls
+
+def gc_capture(buf, n_samples, mask):
+    # capture n_samples rows from the channels in mask into buf with the garbage collector off, so that a long capture
+    # can not be held up by a collection part way through, then send them as a binary frame, see write_frame,
+    # and a line with the values in GC_REPORT
+    # the heap is collected first so that the collector has no reason to run again straight after the capture
+
+    FUNC_NAME = ".gc_capture()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        channels = get_channels(mask)
+        if len(channels) > 0:
+            max_samples = min(len(buf) // len(channels), MAX_FRAME_SAMPLES)
+            n_samples = max_samples if n_samples <= 0 else min(n_samples, max_samples)
+            gc.collect()
+            start_time = time.monotonic_ns()
+            mem_free = gc.mem_free()
+            gc.disable()
+            try:
+                sample_gc_free(buf, n_samples, channels, gc_stats)
+                alloc = mem_free - gc.mem_free()
+                elapsed = time.monotonic_ns() - start_time
+            finally:
+                gc.enable()
+            write_frame(buf, n_samples, mask)
+            achieved = n_samples * 1.0e9 / elapsed if elapsed > 0 else 0.0
+            print(achieved, gc_stats[0], gc_stats[1], mem_free, alloc)
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo channels selected"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def new_timing():
+    # running totals for sample_paced, no. rows, sum and sum of squares of the lateness in us, max lateness,
+    # no. rows late by a whole period, time of the first and last rows in ns
+    return [0, 0, 0, 0, 0, 0, 0]
+
+def sample_paced(buf, n_samples, channels, period_ns, deadline, timing):
+    # as sample_channels but row k is taken at deadline + k * period_ns on the time.monotonic_ns() clock
+    # a late row is taken straight away and the rows after it keep to the original schedule, so the rate does not drift
+    # the lateness of each row is added to timing, see new_timing, returns the deadline of the next row
+
+    i = 0
+    for n in range(0, n_samples, 1):
+        now = time.monotonic_ns()
+        while now < deadline:
+            now = time.monotonic_ns()
+        for pin in channels:
+            buf[i] = pin.value
+            i = i + 1
+        late = (now - deadline) // 1000
+        if timing[0] == 0:
+            timing[5] = now
+        timing[0] = timing[0] + 1
+        timing[1] = timing[1] + late
+        timing[2] = timing[2] + late * late
+        if late > timing[3]:
+            timing[3] = late
+        if late * 1000 >= period_ns:
+            timing[4] = timing[4] + 1
+        timing[6] = now
+        deadline = deadline + period_ns
+    return deadline
+
+def timing_report(timing, rate):
+    # the values in TIMING for the totals in timing
+    n = timing[0]
+    mean = timing[1] / n if n > 0 else 0.0
+    rms = math.sqrt(timing[2] / n) if n > 0 else 0.0
+    achieved = (n - 1) * 1.0e9 / (timing[6] - timing[5]) if n > 1 and timing[6] > timing[5] else 0.0
+    return (rate, achieved, mean, rms, timing[3], timing[4])
+
+def paced_capture(buf, rate, n_samples, mask):
+    # capture n_samples rows from the channels in mask at rate Hz into buf, send them as a binary frame, see write_frame,
+    # then a line with the timing of the capture, see TIMING
+
+    FUNC_NAME = ".paced_capture()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        channels = get_channels(mask)
+        if rate > 0.0 and len(channels) > 0:
+            n_samples = min(n_samples, len(buf) // len(channels), MAX_FRAME_SAMPLES)
+            timing = new_timing()
+            sample_paced(buf, n_samples, channels, int(1.0e9 / rate), time.monotonic_ns(), timing)
+            write_frame(buf, n_samples, mask)
+            print(*timing_report(timing, rate))
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNeed rate > 0 and at least one channel"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def write_frame(buf, n_samples, mask):
+    # write the first n_samples rows of raw counts in buf to the serial port as a single length-prefixed binary frame
+    # the counts are sent straight from the buffer, no copy is made
+
+    if frame_encoding == ENCODE_DELTA:
+        write_encoded_frame(buf, n_samples, mask)
+        return
+    n_counts = n_samples * len(get_channels(mask))
+    console_write(struct.pack(FRAME_HEADER, frameStartStr, mask, n_samples, 2 * n_counts))
+    console_write(memoryview(buf)[0:n_counts])
+
+def put_varint(out, k, v):
+    # write the unsigned integer v into out from position k, 7 bits per byte with the top bit set on all but the last
+    # returns the position after it
+    while v >= 0x80:
+        out[k] = (v & 0x7F) | 0x80
+        k = k + 1
+        v = v >> 7
+    out[k] = v
+    return k + 1
+
+def write_encoded_frame(buf, n_samples, mask, start = 0):
+    # write n_samples rows of raw counts in buf to the serial port as a compressed frame, see encodedStartStr
+    # the rows are read from start onwards, wrapping round at the end of the n_samples rows, for the ring buffer of triggered_capture
+    # the frame is built and sent ENCODE_CHUNK bytes at a time in encode_buf, so the only memory needed is that one chunk
+
+    n_channels = len(get_channels(mask))
+    n_counts = n_samples * n_channels
+
+    # low bits that are zero in every count, e.g. the 4 bits below the 12-bit ADC reading, are not sent
+    low = 0
+    for i in range(0, n_counts, 1):
+        low = low | buf[i]
+    shift = 0
+    while shift < ADC_SHIFT and not (low >> shift) & 1:
+        shift = shift + 1
+    console_write(struct.pack(ENCODED_HEADER, encodedStartStr, mask, n_samples, shift))
+
+    # the channels are sent one after the other so that a channel that hardly changes gives long runs of zeros
+    out = encode_buf
+    k = 2 # the first two bytes hold the chunk length
+    run = 0
+    s1 = 0
+    s2 = 0
+    for j in range(0, n_channels, 1):
+        prev = 0
+        idx = start + j
+        for n in range(0, n_samples, 1):
+            c = buf[idx]
+            idx = idx + n_channels
+            if idx >= n_counts:
+                idx = idx - n_counts
+            s1 = (s1 + c) % 0xFFFF
+            s2 = (s2 + s1) % 0xFFFF
+            v = c >> shift
+            d = v - prev
+            prev = v
+            if d == 0:
+                run = run + 1
+            else:
+                if run > 0:
+                    out[k] = 0
+                    k = put_varint(out, k + 1, run)
+                    run = 0
+                k = put_varint(out, k, d << 1 if d > 0 else ((-d) << 1) - 1)
+                if k >= ENCODE_CHUNK:
+                    out[0] = (k - 2) & 0xFF
+                    out[1] = (k - 2) >> 8
+                    console_write(memoryview(out)[0:k])
+                    k = 2
+    if run > 0:
+        out[k] = 0
+        k = put_varint(out, k + 1, run)
+    if k > 2:
+        out[0] = (k - 2) & 0xFF
+        out[1] = (k - 2) >> 8
+        console_write(memoryview(out)[0:k])
+    console_write(struct.pack('<HI', 0, (s2 << 16) | s1))
+
+def stream(buf, n_samples, mask, rate = 0.0):
+    # sample the channels in mask continuously in blocks of n_samples until the host sends a command
+    # rate > 0 paces the samples to rate Hz, see sample_paced, otherwise they are taken as fast as possible
+    # buf is split in two, one half is filled while the previous block is sent from the other half in STREAM_CHUNKS pieces,
+    # so the gaps in sampling while data is sent are short and evenly spread rather than one long dump
+    # each block goes out as a binary frame with an incrementing sequence number and the time of its first sample
+    # once the stream stops, a paced stream sends a line with the timing of all of its samples, see TIMING
+
+    FUNC_NAME = ".stream()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        channels = get_channels(mask)
+        n_channels = len(channels)
+        if n_channels > 0 and n_samples > 0:
+            # blocks are a whole number of chunks and two of them must fit in the buffer
+            n_samples = min(n_samples, len(buf) // (2 * n_channels), MAX_FRAME_SAMPLES)
+            chunk_samples = max(1, n_samples // STREAM_CHUNKS)
+            n_chunks = n_samples // chunk_samples
+            n_samples = n_chunks * chunk_samples
+            chunk_counts = chunk_samples * n_channels
+            n_counts = n_samples * n_channels
+
+            # make all the views and the header once, nothing is allocated while streaming
+            view = memoryview(buf)
+            halves = [[view[h*n_counts + k*chunk_counts:h*n_counts + (k+1)*chunk_counts] for k in range(0, n_chunks, 1)] for h in range(0, 2, 1)]
+            header = bytearray(struct.calcsize(STREAM_HEADER))
+
+            period_ns = int(1.0e9 / rate) if rate > 0.0 else 0
+            timing = new_timing()
+            # the sum and sum of squares of the lateness are moved out of timing once per block into these floats,
+            # so that those in timing cover one block and stay small ints however long the stream runs
+            late_sums = [0.0, 0.0]
+
+            seq = 0
+            cur = 0
+            deadline = time.monotonic_ns()
+            t_cur = deadline
+            for chunk in halves[cur]:
+                if period_ns > 0:
+                    deadline = sample_paced(chunk, chunk_samples, channels, period_ns, deadline, timing)
+                else:
+                    sample_channels(chunk, chunk_samples, channels)
+            while not supervisor.runtime.serial_bytes_available:
+                prev = cur
+                cur = 1 - cur
+                t_prev = t_cur
+                t_cur = deadline if period_ns > 0 else time.monotonic_ns() # scheduled or actual time of the first sample
+                struct.pack_into(STREAM_HEADER, header, 0, streamStartStr, mask, n_samples, 2 * n_counts, seq, (t_prev // 1000) & US_WRAP)
+                console_write(header)
+                for k in range(0, n_chunks, 1):
+                    if period_ns > 0:
+                        deadline = sample_paced(halves[cur][k], chunk_samples, channels, period_ns, deadline, timing)
+                    else:
+                        sample_channels(halves[cur][k], chunk_samples, channels)
+                    console_write(halves[prev][k])
+                seq = seq + 1
+                late_sums[0] = late_sums[0] + timing[1]
+                late_sums[1] = late_sums[1] + timing[2]
+                timing[1] = 0
+                timing[2] = 0
+            # send the block that was filled while the last one went out
+            struct.pack_into(STREAM_HEADER, header, 0, streamStartStr, mask, n_samples, 2 * n_counts, seq, (t_cur // 1000) & US_WRAP)
+            console_write(header)
+            for chunk in halves[cur]:
+                console_write(chunk)
+            input() # the command that stopped the stream
+            if period_ns > 0:
+                timing[1] = timing[1] + late_sums[0]
+                timing[2] = timing[2] + late_sums[1]
+                print(*timing_report(timing, rate))
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo channels or samples requested"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def triggered_capture(buf, n_pre, n_post, mask, trig_ch, level, edge = 1, timeout = 1.0):
+    # sample the channels in mask continuously into buf used as a ring buffer until Vin<trig_ch + 1> crosses level volts
+    # edge > 0 triggers on a rising crossing, edge < 0 on a falling one and edge = 0 on either
+    # the trigger channel is always captured, the trigger is only armed once the n_pre pre-trigger rows are in the ring
+    # once it fires n_post rows are taken, starting with the row that fired, and the n_pre + n_post rows are sent
+    # in time order as a binary frame, see write_frame
+    # if nothing fires within timeout seconds an empty frame is sent, timeout <= 0 waits until a command arrives
+
+    FUNC_NAME = ".triggered_capture()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        if trig_ch < 0 or trig_ch >= len(Vin_pins):
+            ERR_STATEMENT = ERR_STATEMENT + "\nTrigger channel must be in the range [0, %(v1)d)"%{"v1":len(Vin_pins)}
+            raise Exception
+        mask = mask | (1 << trig_ch)
+        channels = get_channels(mask)
+        n_channels = len(channels)
+        n_rows = n_pre + n_post
+        if n_pre < 0 or n_post < 1 or n_rows * n_channels > len(buf) or n_rows > MAX_FRAME_SAMPLES:
+            ERR_STATEMENT = ERR_STATEMENT + "\nWindow must have post > 0 and fit in the capture buffer"
+            raise Exception
+
+        # everything the loop needs is worked out before it starts, the trigger level is compared as a raw count
+        n_counts = n_rows * n_channels
+        trig_idx = channels.index(Vin_pins[trig_ch]) - n_channels # position of the trigger count relative to the end of a row
+        level_count = int(level * counts_per_volt)
+        rising = edge >= 0
+        falling = edge <= 0
+        deadline = time.monotonic() + timeout
+
+        i = 0
+        n_armed = 0
+        remaining = 0
+        check = 0
+        fired = False
+        prev = Vin_pins[trig_ch].value
+        while True:
+            for pin in channels:
+                buf[i] = pin.value
+                i = i + 1
+            cur = buf[i + trig_idx]
+            if i == n_counts:
+                i = 0
+            if fired:
+                remaining = remaining - 1
+                if remaining == 0:
+                    break
+            else:
+                if n_armed < n_pre:
+                    n_armed = n_armed + 1
+                elif (rising and prev < level_count and cur >= level_count) or (falling and prev >= level_count and cur < level_count):
+                    fired = True
+                    remaining = n_post - 1
+                    if remaining == 0:
+                        break
+                prev = cur
+                check = check + 1
+                if check == TRIGGER_CHECK:
+                    check = 0
+                    if timeout > 0.0:
+                        if time.monotonic() > deadline:
+                            break
+                    elif supervisor.runtime.serial_bytes_available:
+                        input() # the command that cancelled the capture
+                        break
+
+        if fired and frame_encoding == ENCODE_DELTA:
+            write_encoded_frame(buf, n_rows, mask, i)
+        elif fired:
+            # the oldest row is where the next one would have been written
+            console_write(struct.pack(FRAME_HEADER, frameStartStr, mask, n_rows, 2 * n_counts))
+            view = memoryview(buf)
+            console_write(view[i:n_counts])
+            console_write(view[0:i])
+        else:
+            console_write(struct.pack(FRAME_HEADER, frameStartStr, mask, 0, 0))
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def window_stats(n_samples, mask = (1 << 1), stat_mask = ALL_STATS):
+    # sample the channels in mask n_samples times and reduce the raw counts with running integer accumulators
+    # counts are converted to volts once at the end, so the sampling loop does no float arithmetic
+    # sums and squares are accumulated STATS_BLOCK samples at a time in block accumulators that stay small ints,
+    # which are not allocated on the heap, and added to the window totals once per block
+    # over a long window the totals outgrow the small int range and become long ints, so that addition can allocate,
+    # but only once every STATS_BLOCK samples rather than on every sample
+    # returns the list of selected statistics for each channel in turn, see STATS
+
+    FUNC_NAME = ".window_stats()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        channels = get_channels(mask)
+        n_channels = len(channels)
+        if n_channels > 0 and n_samples > 0:
+            mins = [bit_scale] * n_channels
+            maxs = [0] * n_channels
+            sums = [0] * n_channels # sum for the current block of STATS_BLOCK samples
+            sqs = [0] * n_channels # sum of squares for the current block
+            totals = [0] * n_channels
+            sq_totals = [0] * n_channels
+            count = 0
+            while count < n_samples:
+                block = min(STATS_BLOCK, n_samples - count)
+                for n in range(0, block, 1):
+                    for j in range(0, n_channels, 1):
+                        v = channels[j].value
+                        if v < mins[j]: mins[j] = v
+                        if v > maxs[j]: maxs[j] = v
+                        sums[j] = sums[j] + v
+                        v = v >> ADC_SHIFT
+                        sqs[j] = sqs[j] + v * v
+                for j in range(0, n_channels, 1):
+                    totals[j] = totals[j] + sums[j]
+                    sq_totals[j] = sq_totals[j] + sqs[j]
+                    sums[j] = 0
+                    sqs[j] = 0
+                count = count + block
+
+            # convert to volts, once, all of the statistics in counts for all of the channels together
+            n_volts = len(STATS) - 1 # every statistic but the no. of samples
+            stats = []
+            for j in range(0, n_channels, 1):
+                stats.extend((mins[j], maxs[j], totals[j] / n_samples, math.sqrt(sq_totals[j] / n_samples) * (1 << ADC_SHIFT), maxs[j] - mins[j]))
+            counts_to_volts(stats, len(stats), stats)
+            vals = []
+            for j in range(0, n_channels, 1):
+                for k in range(0, len(STATS), 1):
+                    if stat_mask & (1 << k):
+                        vals.append(stats[n_volts * j + k] if k < n_volts else n_samples)
+            return vals
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo channels or samples requested"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def read_block(n_samples, mask = ALL_CHANNELS):
+    # read n_samples raw counts from each of the channels in mask
+    # and write them to the serial port as a single length-prefixed binary frame
+    # no voltage conversion or string formatting is done here, that is left to the host
+
+    FUNC_NAME = ".read_block()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        channels = get_channels(mask)
+        if len(channels) > 0 and n_samples > 0:
+            n_samples = min(n_samples, MAX_BLOCK // len(channels))
+            counts = new_buffer(n_samples * len(channels)) # preallocated, no per-sample allocation
+            if oversample_n == 1:
+                sample_channels(counts, n_samples, channels)
+            else:
+                i = 0
+                for n in range(0, n_samples, 1):
+                    for pin in channels:
+                        counts[i] = read_count(pin)
+                        i = i + 1
+            write_frame(counts, n_samples, mask)
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo channels or samples requested"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def sweep_points(start, stop, step):
+    # number of set points in a sweep from start to stop inclusive
+    # the host uses the same formula to recover the set voltages
+
+    if step > 0.0 and stop >= start:
+        return int((stop - start) / step + 1.0e-6) + 1
+    else:
+        return 0
+
+def sweep(start, stop, step, settle = 0.01, n_reads = 1, mask = ALL_CHANNELS):
+    # step Vout from start to stop inclusive in steps of step
+    # at each set point wait settle seconds then send n_reads raw counts from each channel in mask
+    # as a binary frame, see read_block, so the whole table goes back in a single transaction
+    # set points outside the range of the board are replaced by zero, as for writeAngStrA
+
+    FUNC_NAME = ".sweep()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        n_points = sweep_points(start, stop, step)
+        if n_points > 0:
+            # work out the DAC codes for all the set points before the sweep starts
+            codes = []
+            for k in range(0, n_points, 1):
+                SetVoltage = start + k * step
+                codes.append(dac_value(SetVoltage if SetVoltage >= 0.0 and SetVoltage < Vmax else 0.0))
+            for code in codes:
+                set_output(code)
+                if settle > 0.0:
+                    time.sleep(settle)
+                read_block(n_reads, mask)
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nSweep must have step > 0 and stop >= start"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def regulate_current(target, kp = CC_KP, ki = CC_KI, tol = CC_TOL, n_report = CC_REPORT, duration = 0.0):
+    # hold the current through R3 at target mA with a PI loop on Vout, using the Vin3 / Vin4 readback
+    # IR3 = (Vin3 - Vin4) * Vscale / R3 as in Current_Source_Measurement, and Vout starts at the open-loop value target * R1 * R3 / R2
+    # every n_report iterations a line is sent with the elapsed time in s, the mean current in mA over those iterations,
+    # the output voltage and 1 once the current has stayed within tol mA of target for CC_SETTLE_COUNT iterations, 0 otherwise
+    # the loop runs until a command arrives, or for duration seconds if duration > 0, and Vout is left at its last value
+
+    FUNC_NAME = ".regulate_current()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        if n_report > 0:
+            cal = get_calibration()
+            deltaV = cal['offset'][0] if cal['offset'][0] > 0.0 else 0.0
+            # work out the current directly from the raw counts, the scale factors are fixed for the whole run
+            k3 = cal['gain'][2] * volts_per_count / R3
+            k4 = cal['gain'][3] * volts_per_count / R3
+            i0 = deltaV * (cal['gain'][2] - cal['gain'][3]) / R3
+            v_ff = target * R1 * R3 / R2
+            v_top = Vmax - volts_per_count # largest output the DAC can reach
+            vset = min(max(v_ff, 0.0), v_top)
+            set_output(dac_value(vset))
+
+            integral = 0.0
+            n_in = 0
+            count = 0
+            total = 0.0
+            start_time = time.monotonic_ns()
+            last_time = start_time
+            while True:
+                current = Vin3.value * k3 - Vin4.value * k4 - i0
+                now = time.monotonic_ns()
+                dt = (now - last_time) * 1.0e-9
+                last_time = now
+                error = target - current
+                u = v_ff + kp * error + ki * (integral + error * dt)
+                if u < 0.0:
+                    vset = 0.0
+                elif u > v_top:
+                    vset = v_top
+                else:
+                    vset = u
+                    integral = integral + error * dt # only integrate when the output is not saturated
+                set_output(dac_value(vset))
+                n_in = n_in + 1 if abs(error) <= tol else 0
+                total = total + current
+                count = count + 1
+                if count == n_report:
+                    elapsed_time = (now - start_time) * 1.0e-9
+                    print(elapsed_time, total / count, vset, 1 if n_in >= CC_SETTLE_COUNT else 0)
+                    count = 0
+                    total = 0.0
+                    if duration > 0.0 and elapsed_time >= duration:
+                        break
+                    if supervisor.runtime.serial_bytes_available:
+                        input() # the command that stopped the loop is consumed here
+                        break
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nIterations per report must be > 0"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
 def Blink():
     # The first script that is run using CircuitPy
     # Use this to check that everything is operational
@@ -118,11 +926,12 @@ def Voltage_Divider_Test():
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        # determine the zero offset
-        deltaV = get_zero_offset()
+        # determine the zero offset, from the calibration cache unless it needs to be measured again
+        cal = get_calibration()
+        deltaV = cal['offset'][0]
 
         # define the voltage-divider scaling
-        Vscale = (5.0/3.0)
+        Vscale = cal['gain'][1]
 
         # Read the values here
         # Determine the readings at pins A2, A3, A4, A5
@@ -149,10 +958,11 @@ def Current_Source_Measurement():
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        deltaV = get_zero_offset()
+        cal = get_calibration()
+        deltaV = cal['offset'][0]
 
         # define the voltage-divider scaling
-        Vscale = (5.0/3.0)
+        Vscale = cal['gain'][1]
 
         # Set the output value here
         Vset = 0.0
@@ -161,7 +971,7 @@ def Current_Source_Measurement():
         R3 = (4.8/1000.0) # units of kOhm
         ratio = R2 / (R1*R3)
         Rload = (10.0/1000.0) # unit of kOhm
-        Vout.value = dac_value(Vset)
+        set_output(dac_value(Vset))
 
         # Read the values here
         # Determine the readings at pins A2, A3, A4, A5
@@ -186,39 +996,252 @@ def Current_Source_Measurement():
         print(ERR_STATEMENT)
         print(e)
 
+# Command handlers
+# Each handler is passed the text that follows the command character and prints its reply, if it has one
+# A handler raises ValueError when its arguments can not be understood, the caller reports it and carries on listening
+# The handlers are gathered into one dispatch table per interface method below, keyed on the command character
+
+def parse_args(args, defaults):
+    # convert the comma separated arguments of a command, each one takes the type of its default
+    # missing arguments take their default, a default of None marks a required float
+    vals = args.split(',') if args.strip() else []
+    out = []
+    for i in range(0, len(defaults), 1):
+        if i < len(vals) and vals[i].strip():
+            out.append(int(vals[i]) if isinstance(defaults[i], int) else float(vals[i]))
+        elif defaults[i] is None:
+            raise ValueError('Argument %(v1)d is required'%{"v1":i + 1})
+        else:
+            out.append(defaults[i])
+    return out
+
+def cmd_write(args):
+    # writeAngStrA<volts>, set the analog output, out of range voltages set it to zero
+    SetVoltage = float(args)     # Everything after the writeAngStrA is the voltage
+    if SetVoltage >= 0.0 and SetVoltage < Vmax: # Sets limits on the Output voltage to board specs
+        set_output(dac_value(SetVoltage)) # Set the voltage
+    else:
+        set_output(dac_value(0.0)) # Set the voltage to zero in the event of SetVoltage range error
+
+def cmd_read(args):
+    # readAngStr, voltages at Vin1 .. Vin5
+    # in the scheme I have set up
+    # A1 measures Ground, A2 measures Vctrl-high, A3 measures Vr3-high, A4 measures Vr3-low, A5 measures Vrl-high
+    # Measurement at ground can be substracted off where required
+    # when oversampling the no. samples averaged for each voltage follows them
+    if oversample_n == 1:
+        print(get_voltage(Vin1), get_voltage(Vin2), get_voltage(Vin3), get_voltage(Vin4), get_voltage(Vin5)) # Prints to serial to be read by LabView
+    else:
+        print(get_voltage(Vin1), get_voltage(Vin2), get_voltage(Vin3), get_voltage(Vin4), get_voltage(Vin5), oversample_n)
+
+def cmd_read_block(args):
+    # readBlockStr<samples>,<channel mask>, binary frame of raw counts
+    # in query mode the no. samples averaged for each count follows the frame, the frame itself does not say
+    n_samples, mask = parse_args(args, (1, ALL_CHANNELS))
+    read_block(n_samples, mask)
+    if query_mode:
+        print(oversample_n)
+
+def cmd_sweep(args):
+    # sweepCmdStr<start>,<stop>,<step>,<settle>,<reads>,<mask>
+    start, stop, step, settle, n_reads, mask = parse_args(args, (None, None, None, 0.01, 1, ALL_CHANNELS))
+    sweep(start, stop, step, settle, n_reads, mask)
+    if query_mode:
+        print(oversample_n) # as for readBlockStr
+
+def cmd_current(args):
+    # currentCmdStr<target mA>,<kp>,<ki>,<tolerance mA>,<iterations per report>,<duration>, constant current mode
+    target, kp, ki, tol, n_report, duration = parse_args(args, (None, CC_KP, CC_KI, CC_TOL, CC_REPORT, 0.0))
+    regulate_current(target, kp, ki, tol, n_report, duration)
+
+def cmd_oversample(args):
+    # oversampleCmdStr<samples>,<extra bits> sets the oversampling, oversampleCmdStr? reports it, oversampleCmdStr alone switches it off
+    if args.strip() != '?':
+        n_samples, bits = parse_args(args, (1, -1))
+        set_oversampling(n_samples, bits)
+    print(oversample_n, oversample_bits)
+
+def cmd_encoding(args):
+    # encodeCmdStr<encoding> sets the encoding of the binary frames, encodeCmdStr? reports it
+    global frame_encoding
+    arg = args.strip()
+    if arg != '?':
+        encoding = int(arg) if arg else ENCODE_RAW
+        if encoding != ENCODE_RAW and encoding != ENCODE_DELTA:
+            raise ValueError('Encoding must be %(v1)d or %(v2)d'%{"v1":ENCODE_RAW, "v2":ENCODE_DELTA})
+        frame_encoding = encoding
+    print(frame_encoding)
+
+def cmd_calibration(args):
+    # calCmdStr re-measures the calibration, calCmdStr? reports the cached values, calCmdStr<max age> sets the max age
+    arg = args.strip()
+    if arg == '?':
+        cal = calibration if calibration['time'] is not None else get_calibration()
+    elif arg:
+        calibration['max_age'] = float(arg) # Everything after the calCmdStr is the max age in seconds
+        cal = get_calibration()
+    else:
+        cal = get_calibration(True)
+    print(time.monotonic() - cal['time'], *(cal['offset'] + cal['gain'])) # age, offsets, gains
+
+def cmd_identify(args):
+    # identifyStr, which board this is and which interface method it is running
+    if args.strip() != identifyStr[1:]:
+        raise ValueError('Unknown command *' + args)
+    print(identify(iface_name))
+
+def cmd_query_mode(args):
+    # queryModeStr1 switches query mode on, queryModeStr0 switches it off
+    global query_mode
+    query_mode = args.strip() != '0'
+
+def cmd_capture(args):
+    # captureCmdStr<samples>,<channel mask>, capture into the preallocated buffer, zero samples fills the buffer
+    n_samples, mask = parse_args(args, (0, (1 << 1))) # Vin2 by default as for readCmdStr
+    channels = get_channels(mask)
+    if len(channels) == 0:
+        raise ValueError('No channels selected')
+    # zero samples, or more than will fit, means fill the buffer
+    max_samples = min(len(capture_buf) // len(channels), MAX_FRAME_SAMPLES)
+    n_samples = max_samples if n_samples <= 0 else min(n_samples, max_samples)
+    sample_channels(capture_buf, n_samples, channels)
+    write_frame(capture_buf, n_samples, mask)
+
+def cmd_gc_capture(args):
+    # gcCaptureCmdStr<samples>,<channel mask>, capture into the preallocated buffer with the garbage collector off, see gc_capture
+    n_samples, mask = parse_args(args, (0, (1 << 1))) # Vin2 by default as for readCmdStr
+    gc_capture(capture_buf, n_samples, mask)
+
+def cmd_trigger(args):
+    # triggerCmdStr<pre>,<post>,<channel mask>,<trigger channel>,<level V>,<edge>,<timeout s>, see triggered_capture
+    n_pre, n_post, mask, trig_ch, level, edge, timeout = parse_args(args, (100, 400, (1 << 1), 1, 1.0, 1, 1.0))
+    triggered_capture(capture_buf, n_pre, n_post, mask, trig_ch, level, edge, timeout)
+
+def cmd_stream(args):
+    # streamCmdStr<samples per block>,<channel mask>, stream blocks until the next command arrives
+    n_samples, mask, rate = parse_args(args, (256, (1 << 1), 0.0)) # Vin2 by default as for readCmdStr
+    stream(capture_buf, n_samples, mask, rate)
+
+def cmd_rate(args):
+    # rateCmdStr<rate Hz>,<samples>,<channel mask>, paced capture into the preallocated buffer
+    rate, n_samples, mask = parse_args(args, (None, 1000, (1 << 1)))
+    paced_capture(capture_buf, rate, n_samples, mask)
+
+def cmd_stats(args):
+    # statsCmdStr<window>,<channel mask>,<statistics mask>
+    n_samples, mask, stat_mask = parse_args(args, (500, (1 << 1), ALL_STATS))
+    vals = window_stats(n_samples, mask, stat_mask)
+    if vals is not None:
+        print(*vals)
+
+def cmd_ac_read(args):
+    # readCmdStr on AC_Read, dump a run of raw counts from Vin2 with the time taken
+    # the counts go into the preallocated capture buffer with the garbage collector off rather than onto a growing list
+    count = 0
+    count_lim = 500
+    #count_lim = 3e+4 # i think this is close to the upper limit
+    bit_readings_1 = capture_buf
+    #bit_readings_2 = []
+    gc.collect()
+    start_time = time.monotonic_ns() # start the clock, time.time() only counts whole seconds
+    gc.disable()
+    try:
+        sample_channels(bit_readings_1, count_lim, (Vin2,)) # no voltage conversions here
+        elapsed_time = (time.monotonic_ns() - start_time) * 1.0e-9
+    finally:
+        gc.enable()
+
+    delta_T = float(elapsed_time / count_lim)
+
+    # output the data to the buffer
+    count = 0
+    print("Elapsed Time: %(v1)0.15f"%{"v1":elapsed_time})
+    print("Time-step: %(v1)0.15f"%{"v1":delta_T})
+    print("Start")
+    for i in range(0, count_lim, 1):
+        print(bit_readings_1[i])
+    print("End")
+
+def cmd_ac_max(args):
+    # readCmdStr on AC_Max, largest voltage seen at Vin2 over 500 reads
+    #print(get_voltage(Vin1), get_voltage(Vin2), get_voltage(Vin3), get_voltage(Vin4), get_voltage(Vin5)) # Prints to serial to be read by LabView
+    max_val = 0
+    count = 0
+    count_lim = 500
+    while count < count_lim:
+        t1 = Vin2.value # read the raw count from the pin, convert to voltage once at the end
+        if t1 > max_val: max_val = t1
+        count = count + 1
+        time.sleep(0.001)
+    print(max_val * volts_per_count)
+
+# Dispatch tables, the commands understood by every interface method are in common_commands
+common_commands = {identifyStr[0]:cmd_identify, queryModeStr:cmd_query_mode, encodeCmdStr:cmd_encoding}
+cuffe_commands = {writeAngStrA:cmd_write, readAngStr:cmd_read, readBlockStr:cmd_read_block, sweepCmdStr:cmd_sweep,
+                  calCmdStr:cmd_calibration, currentCmdStr:cmd_current, oversampleCmdStr:cmd_oversample}
+ac_read_commands = {readCmdStr:cmd_ac_read, captureCmdStr:cmd_capture, streamCmdStr:cmd_stream, rateCmdStr:cmd_rate,
+                    triggerCmdStr:cmd_trigger, gcCaptureCmdStr:cmd_gc_capture}
+ac_max_commands = {readCmdStr:cmd_ac_max, statsCmdStr:cmd_stats}
+
+iface_name = '' # name of the interface method that is listening, reported by identify
+capture_buf = None # preallocated by AC_Read for captureCmdStr and streamCmdStr
+
+def listen(iface, commands, default = None):
+    # listen for serial commands and pass each one to its handler in commands, or common_commands
+    # a line may hold several commands separated by batchSepStr, e.g. a1.25;l;l;l, they are run and answered in order
+    # so the host can send a whole batch in one write and the USB round trip is paid once
+    # in query mode each reply is closed by replyEndStr, and a command that is not understood gets an error reply
+    # outside query mode a command that is not understood goes to default, if there is one, as LabVIEW expects
+    # commands sent as seqStr<seq>:<command> get a checked reply, see seqStr
+
+    global iface_name, checking, reply_crc
+
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + "." + iface + "()"
+
+    iface_name = iface
+    table = dict(common_commands)
+    table.update(commands)
+    while True:
+        if supervisor.runtime.serial_bytes_available:   # Listens for a serial command
+            batch = input().split(batchSepStr)
+            for command in batch:
+                command = command.strip()
+                if command or len(batch) == 1:          # empty commands inside a batch are ignored, so a line holding only batchSepStr gets no reply
+                    seq = None
+                    if command.startswith(seqStr):      # a checked command, strip off the sequence no.
+                        indx = command.find(':')
+                        seq = command[1:indx] if indx > 0 else command[1:]
+                        command = command[indx + 1:] if indx > 0 else ''
+                        console_print(seqStr + seq)
+                        reply_crc = 0
+                        checking = True
+                    handler = table.get(command[0:1], None if query_mode or seq is not None else default)
+                    try:
+                        if handler is None:
+                            raise ValueError('Unknown command ' + command)
+                        handler(command[1:])
+                    except Exception as e:                 # whatever goes wrong in a handler is reported, the interface keeps listening
+                        print(ERR_STATEMENT)
+                        print(e)
+                    finally:
+                        checking = False
+                    if seq is not None:
+                        console_print(replyEndStr + seq, reply_crc) # Tell the host the reply is complete and what it should have been
+                    elif query_mode:
+                        print(replyEndStr)              # Tell the host that the reply is complete
+
 def Cuffe_Iface():
     # method that listens for input from LabVIEW and responds appropriately
     # John Cuffe 10 - 10 - 2020
     # Edited R. Sheehan 27 - 10 - 2020
 
+    # The commands are looked up in cuffe_commands, see listen
+
     FUNC_NAME = ".Cuffe_Iface()" # use this in exception handling messages
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        while True:
-            if supervisor.runtime.serial_bytes_available:   # Listens for a serial command
-                command = input()
-                if command.startswith(writeAngStrA):        # If the command starts with writeAngStrA it knows it is an output (Write)
-                    try:                                    # In case user inputs NAN somehow
-                        SetVoltage = float(command[1:])     # Everything after the writeAngStrA is the voltage
-                        if SetVoltage >= 0.0 and SetVoltage < 3.3: # Sets limits on the Output voltage to board specs
-                            Vout.value = dac_value(SetVoltage) # Set the voltage
-                        else:
-                            Vout.value = dac_value(0.0) # Set the voltage to zero in the event of SetVoltage range error
-                    except ValueError:
-                        ERR_STATEMENT = ERR_STATEMENT + '\nVin must be a float'
-                        raise Exception
-                elif command.startswith(readAngStr):        # If the command starts with readAngStr it knows user is looking for Vin. (Read)
-                    # in the scheme I have set up
-                    # A1 measures Ground, A2 measures Vctrl-high, A3 measures Vr3-high, A4 measures Vr3-low, A5 measures Vrl-high
-                    # Measurement at ground can be substracted off where required
-                    print(get_voltage(Vin1), get_voltage(Vin2), get_voltage(Vin3), get_voltage(Vin4), get_voltage(Vin5)) # Prints to serial to be read by LabView
-                    #print(get_voltage(Vin2))
-                    #print(Vin1.value)
-                else:
-                    print(get_voltage(Vin1), get_voltage(Vin2), get_voltage(Vin3), get_voltage(Vin4), get_voltage(Vin5)) # Prints to serial to be read by LabView
-                    #print(get_voltage(Vin2))
-                    #print(Vin1.value)
+        listen("Cuffe_Iface", cuffe_commands, cmd_read) # anything else is a read, as LabVIEW expects
     except Exception as e:
         print(ERR_STATEMENT)
         print(e)
@@ -250,39 +1273,20 @@ def AC_Read():
     # This works to some extent the IBM4 is not able to sample at high enough frequency
     # R. Sheehan 30 - 1 - 2020
 
+    # The captureCmdStr command uses a buffer preallocated when AC_Read starts and sized to the free RAM
+    # so that captures are not limited by list growth and garbage collection
+    # The same buffer is the ring buffer for triggerCmdStr, which only sends the window around a trigger
+    # gcCaptureCmdStr also turns the garbage collector off while it samples, see gc_capture
+
     FUNC_NAME = "AC_Read.()" # use this in exception handling messages
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
+    global capture_buf
+
     try:
-        while True:
-            if supervisor.runtime.serial_bytes_available:   # Listens for a serial command
-                command = input()
-                if command.startswith(readCmdStr):  # If the command starts with readCmdStr it knows user is looking for Vin. (Read)
-                    count = 0
-                    count_lim = 500
-                    #count_lim = 3e+4 # i think this is close to the upper limit
-                    bit_readings_1 = []
-                    #bit_readings_2 = []
-                    start_time = time.time() # start the clock
-                    while count < count_lim:
-                        #bit_readings_1.append(Vin1.value) # no voltage conversions here
-                        bit_readings_1.append(Vin2.value) # no voltage conversions here
-                        count = count + 1
-                    elapsed_time = (time.time() - start_time)
-
-                    delta_T = float(elapsed_time / count_lim)
-
-                    # output the data to the buffer
-                    count = 0
-                    print("Elapsed Time: %(v1)0.15f"%{"v1":elapsed_time})
-                    print("Time-step: %(v1)0.15f"%{"v1":delta_T})
-                    print("Start")
-                    for i in range(0, count_lim, 1):
-                        print(bit_readings_1[i])
-                    print("End")
-                    del bit_readings_1
-                else:
-                    raise Exception        
+        capture_buf = new_buffer(capture_size())
+        gc.collect() # release the bytearray used to build the buffer
+        listen("AC_Read", ac_read_commands)
     except Exception as e:
         print(ERR_STATEMENT)
         print(e)
@@ -293,26 +1297,14 @@ def AC_Max():
     # in a given reading request period
     # R. Sheehan 3 - 11 - 2020
 
+    # The statsCmdStr command generalises this to min / max / mean / RMS / peak-to-peak on any of the channels
+    # computed on the raw counts, see window_stats
+
     FUNC_NAME = "AC_Max.()" # use this in exception handling messages
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        while True:
-            if supervisor.runtime.serial_bytes_available:   # Listens for a serial command
-                command = input()
-                if command.startswith(readCmdStr):                # If the command starts with readCmdStr it knows user is looking for Vin. (Read)
-                    #print(get_voltage(Vin1), get_voltage(Vin2), get_voltage(Vin3), get_voltage(Vin4), get_voltage(Vin5)) # Prints to serial to be read by LabView
-                    max_val = 0.0
-                    count = 0
-                    count_lim = 500
-                    while count < count_lim:
-                        t1 = get_voltage(Vin2) # read the voltage from the pin
-                        if t1 > max_val: max_val = t1
-                        count = count + 1
-                        time.sleep(0.001)                        
-                    print(max_val)
-                else:
-                    raise Exception        
+        listen("AC_Max", ac_max_commands)
     except Exception as e:
         print(ERR_STATEMENT)
         print(e)
@@ -325,11 +1317,11 @@ def IO_Simple():
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        deltaV = get_zero_offset()
+        deltaV = get_calibration()['offset'][0]
 
         Vset = 2.315
 
-        Vout.value = dac_value(Vset) # tell A0 to output Vset Volts
+        set_output(dac_value(Vset)) # tell A0 to output Vset Volts
         time.sleep(0.1) # pause for 100 ms
         print("Reading A1: ",get_voltage(Vin1, 0.0)) # Read the value that is input into A1
         
@@ -10,8 +10,17 @@
 # R. Sheehan 30 - 11 - 2020
 
 import serial # import the pySerial module pip install pyserial
-import pyvisa
+try:
+    import pyvisa
+except ImportError:
+    pyvisa = None # only needed for the VISA backend, see Transport
 import time
+import struct
+import binascii
+import collections
+import numpy
+
+import Transport
 
 # Define the names of the read / write commands
 readCmdStr = 'r'; # read data command string for reading max AC input
@@ -19,11 +28,74 @@ writeCmdStr = 'w'; # write data command string for writing frequency values
 writeAngStrA = 'a'; # write analog output from DCPINA
 writeAngStrB = 'b'; # write analog output from DCPINB
 readAngStr = 'l'; # read analog input
+readBlockStr = 'k'; # read a block of raw analog input counts as a binary frame
+queryModeStr = 'q'; # q1 switches query mode on, q0 switches it off
+identifyStr = '*IDN?'; # identify the board
+captureCmdStr = 'c'; # capture raw counts on the board with AC_Read and send them back as a binary frame
+streamCmdStr = 'm'; # stream raw counts continuously from AC_Read, any command stops the stream
+rateCmdStr = 'f'; # capture at a fixed sample rate on AC_Read and report the timing
+statsCmdStr = 'x'; # statistics over a window of readings from AC_Max
+calCmdStr = 'z'; # zero offset calibration cached on the board
+sweepCmdStr = 's'; # sweep the analog output and read back the table of readings
+triggerCmdStr = 't'; # triggered capture from AC_Read, only the window of samples around the trigger is sent
+gcCaptureCmdStr = 'g'; # capture on AC_Read with the garbage collector off on the board, and report the largest gap between samples
+oversampleCmdStr = 'n'; # oversampling of readAngStr and readBlockStr on the board, n<samples>,<extra bits>
+encodeCmdStr = 'e'; # frame encoding on the board, e0 raw counts, e1 compressed
+currentCmdStr = 'i'; # constant current mode, the board holds the current through R3 with a PI loop on the analog output
+replyEndStr = '$' # in query mode every reply is closed by a line containing only this terminator
+batchSepStr = ';' # separates the commands in a batch sent on one line
+seqStr = '!' # a command sent as !<seq>:<command> gets a checked reply, see Checked_Instrument
+SEQ_WRAP = (1 << 16) # sequence numbers count up to this then start again from 0
+RETRIES = 3 # times a checked command is sent again after a bad reply
+
+# Define the layout of the binary frame, must match Measurement.FRAME_HEADER
+# start byte, channel mask, samples per channel, payload length in bytes, all little-endian
+frameStartStr = b'#'
+FRAME_HEADER = '<cBHI'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+ALL_CHANNELS = 0x1F # mask selecting Vin1 .. Vin5
+MAX_BLOCK = 4096 # max no. counts the board sends in a single frame, must match Measurement.MAX_BLOCK
+IDN_FIELDS = ('maker', 'board', 'firmware', 'iface', 'pins') # fields of the reply to identifyStr
+IDN_MAKER = 'MuCtrl' # first field of the reply to identifyStr, must match Measurement.identify
+
+# Statistics available from statsCmdStr, must match Measurement.STATS
+STATS = ('min', 'max', 'mean', 'rms', 'p2p', 'n')
+ALL_STATS = 0x3F
+
+# Compressed frames, must match Measurement.ENCODED_HEADER, see Decode_Encoded_Frame
+encodedStartStr = b'%'
+ENCODED_HEADER = '<cBHB'
+ENCODED_HEADER_SIZE = struct.calcsize(ENCODED_HEADER)
+ENCODE_RAW = 0
+ENCODE_DELTA = 1
+
+# Streamed blocks, must match Measurement.STREAM_HEADER
+# start byte, channel mask, samples per channel, payload length in bytes, block sequence number, time of first sample in us mod 2^32
+streamStartStr = b'@'
+STREAM_HEADER = '<cBHIII'
+STREAM_HEADER_SIZE = struct.calcsize(STREAM_HEADER)
+US_WRAP = (1 << 32) # block timestamps wrap at this many microseconds
+
+# Timing of a paced capture, must match Measurement.TIMING
+TIMING = ('rate', 'achieved', 'mean_us', 'rms_us', 'max_us', 'late')
+
+# Report of a capture made with the garbage collector off, must match Measurement.GC_REPORT
+GC_REPORT = ('achieved', 'max_gap_ms', 'stalls', 'mem_free', 'alloc')
 
 MOD_NAME_STR = "MicroController"
 HOME = False
 USER = 'Robert' if HOME else 'robertsheehan/OneDrive - University College Cork/Documents'
 
+DELAY = 1 # timed delay in units of seconds
+OPEN_TIMEOUT = 1000 * 60 # timeout for opening a device, seemingly has be in milliseconds
+READ_TIMEOUT = 2000 # timeout for a single read from an open device in milliseconds
+Vmax = 3.3 # max AO/AI value
+bit_scale = (64*1024) # full scale of the raw counts
+N_CHANNELS = 5 # no. analog inputs read by readAngStr, Vin1 .. Vin5
+CC_FIELDS = ('time', 'current', 'vset', 'settled') # fields of each report sent in constant current mode
+N_HARMONICS = 5 # highest harmonic counted in the THD, see Analyse_Signal
+UNIFORM_TOL = 1.0e-3 # sample times further than this fraction of a time step from an even grid are resampled onto one
+
 def Serial_Attempt():
     # Attempting to commubnicate with the ItsyBitsy M4 via Serial comms
     # It isn't really working, but it seems to work fine with the Arduino Micro
@@ -104,19 +176,17 @@ def VISA_Attempt_1():
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        DELAY = 1 # timed delay in units of seconds
-        TIMEOUT = 1000 * 60 # timeout, seemingly has be in milliseconds
         rm = pyvisa.ResourceManager() # determine the addresses of the devices attached to the PC
-        if rm.list_resources():
+        resources = rm.list_resources() # enumerating the devices is slow, do it once
+        if resources:
             # Make a list of the devices attached to the PC
             print("The following devices are connected: ")
-            print(rm.list_resources())
+            print(resources)
 
-            # Create an instance of the instrument at a particular address
-            instr = rm.open_resource(rm.list_resources()[0], open_timeout = TIMEOUT)
-            #instr.read_termination = '\n'
-            #instr.write_termination = '\n'
-            time.sleep(DELAY)
+            # Open a session with the instrument at a particular address
+            # the session configures the terminations and waits for the board once
+            dev = Session(resources[0], rm = rm)
+            instr = dev.instr
             print(instr)
             
             count_lim = 3           
@@ -124,20 +194,16 @@ def VISA_Attempt_1():
             volt = 1.0            
             while volt < volt_lim:
                 # Write a command to that instrument
-                cmd_str = "o%(v1)0.2f"%{"v1":volt}
-                print(cmd_str)                 
-                
-                instr.write(cmd_str)
-                time.sleep(3*DELAY)
+                # the old 'o' command was not recognised by Cuffe_Iface, which replied to it with a reading
+                # that was never read, that is why the reads were out of sync
+                print("%(v1)s%(v2)0.2f"%{"v1":writeAngStrA, "v2":volt})
+                dev.set_voltage(volt) # returns once the board has set the voltage, no need to sleep
 
                 count = 0
                 while count < count_lim:
                     # read data from the instrument
-                    instr.write('l')
-                    time.sleep(DELAY)
-                    print(count, instr.read()) # the syncing of the read command is all fucked up, i don't know what's going on
-                    #print(count, ",", instr.query('l') )
-                    time.sleep(DELAY)
+                    # each query blocks only until the reply terminator arrives
+                    print(count, dev.query(readAngStr)[0])
                     count = count + 1
 
                 volt = volt + 0.5
@@ -148,7 +214,7 @@ def VISA_Attempt_1():
             #instr.clear() # not sure if this is configured for the IBM4 so leave it out for now
 
             # close the device
-            instr.close()
+            dev.close()
         else:
             ERR_STATEMENT = ERR_STATEMENT + "\nNo devices connected"; 
             raise Exception
@@ -168,30 +234,24 @@ def VISA_Attempt_2(voltage):
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        DELAY = 1 # timed delay in units of seconds
-        TIMEOUT = 1000 * 60 # timeout, seemingly has be in milliseconds
         rm = pyvisa.ResourceManager() # determine the addresses of the devices attached to the PC
-        if rm.list_resources():
+        resources = rm.list_resources() # enumerating the devices is slow, do it once
+        if resources:
             # Make a list of the devices attached to the PC
             print("The following devices are connected: ")
-            print(rm.list_resources())
+            print(resources)
 
-            # Create an instance of the instrument at a particular address
-            instr = rm.open_resource(rm.list_resources()[0], open_timeout = TIMEOUT)
-            #instr.read_termination = '\n'
-            #instr.write_termination = '\n'
-            time.sleep(DELAY)
+            # Open a session with the instrument at a particular address
+            # the session configures the terminations and waits for the board once
+            dev = Session(resources[0], rm = rm)
+            instr = dev.instr
             print(instr)
 
-            cmd_str = "o%(v1)0.2f"%{"v1":voltage}
-            instr.write(cmd_str)
-            time.sleep(DELAY)
+            dev.set_voltage(voltage)
             count = 0
             count_lim = 10
             while count < count_lim:
-                instr.write("l")
-                time.sleep(DELAY)
-                print(count,",",instr.read())
+                print(count,",",dev.query(readAngStr)[0])
                 count = count + 1
             
             # trying to simulate what the actual terminal looks like
@@ -228,7 +288,7 @@ def VISA_Attempt_2(voltage):
             #instr.clear() # not sure if this is configured for the IBM4 so leave it out for now
 
             # close the device
-            instr.close()
+            dev.close()
 
             #for i in range(0, len(buf_list), 1):
             #    print(i,",",buf_list[i])
@@ -248,27 +308,25 @@ def Talk_With_Hardware():
     ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
 
     try:
-        DELAY = 1 # timed delay in units of seconds
-        TIMEOUT = 1000 * 60 # timeout, seemingly has be in milliseconds
         rm = pyvisa.ResourceManager() # determine the addresses of the devices attached to the PC
 
-        if rm.list_resources():
+        resources = rm.list_resources() # enumerating the devices is slow, do it once
+        if resources:
             # Make a list of the devices attached to the PC
             print("The following devices are connected: ")
-            for i in range(0, len(rm.list_resources()), 1):
-                print(i,",",rm.list_resources()[i])
+            for i in range(0, len(resources), 1):
+                print(i,",",resources[i])
             print("")
 
             print("Which device would you like to communicate with?")
             indx = int(input())
             
-            if indx > -1 and indx < len(rm.list_resources()):
+            if indx > -1 and indx < len(resources):
                 
-                # Create an instance of the instrument at a particular address
-                instr = rm.open_resource(rm.list_resources()[indx], open_timeout = TIMEOUT)
-                time.sleep(DELAY)
+                # Open a session with the instrument at a particular address
+                dev = Session(resources[indx], rm = rm)
                 print("Open comms to device: ")
-                print(instr)   
+                print(dev.instr)   
                 print("")
                 
                 # run do-while loop to send commands to device and read data output to serial stream
@@ -278,15 +336,11 @@ def Talk_With_Hardware():
                     cmd_str = input() # read the command to be sent to the device from the keyboard
                     if cmd_str == 'exit':
                         run_loop = False
-                    elif cmd_str.startswith(readAngStr):
-                        time.sleep(DELAY)
-                        instr.write(cmd_str)                         
-                        data = instr.read()
-                        #buf_list.append(data)
-                        print(data)
                     else:
-                        instr.write(cmd_str)
-                        time.sleep(DELAY) 
+                        # every command is answered in query mode, print whatever comes back
+                        for data in dev.query(cmd_str):
+                            #buf_list.append(data)
+                            print(data)
 
                 # clear the buffers on the device
                 #instr.clear() # not sure if this is configured for the IBM4 so leave it out for now
@@ -294,7 +348,7 @@ def Talk_With_Hardware():
                 # close the device
                 print("")
                 print("Closing instrument")
-                instr.close()
+                dev.close()
             else:
                 ERR_STATEMENT = ERR_STATEMENT + "\nThat device is not connected"; 
                 raise Exception
@@ -304,3 +358,1181 @@ def Talk_With_Hardware():
     except Exception as e: 
         print(ERR_STATEMENT)
         print(e)
+
+def Channel_Count(mask):
+    # number of channels selected by a channel mask
+
+    return bin(mask & ALL_CHANNELS).count('1')
+
+def Counts_To_Volts(counts):
+    # convert raw counts, e.g. from Read_Block, to voltages
+
+    return numpy.asarray(counts) * (Vmax / bit_scale)
+
+def Sweep_Points(start, stop, step):
+    # set voltages used by Measurement.sweep, the formula must match Measurement.sweep_points
+    # set points outside the range of the board are replaced by zero, as on the board
+
+    n_points = int((stop - start) / step + 1.0e-6) + 1 if step > 0.0 and stop >= start else 0
+    volts = start + step * numpy.arange(n_points)
+    return numpy.where((volts >= 0.0) & (volts < Vmax), volts, 0.0)
+
+def Decode_Frame(header, payload):
+    # convert a binary frame from Measurement.read_block into an array of raw counts
+    # returns an array with one row per sample and one column per channel in the mask
+    # no string parsing is done, the payload is viewed directly as 16-bit integers
+
+    FUNC_NAME = ".Decode_Frame()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        start, mask, n_samples, n_bytes = struct.unpack(FRAME_HEADER, header)
+        n_channels = Channel_Count(mask)
+        if start == frameStartStr and len(payload) == n_bytes and n_bytes == 2 * n_samples * n_channels:
+            return numpy.frombuffer(payload, dtype = '<u2').reshape(n_samples, n_channels)
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nFrame header does not match payload"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Fletcher32(counts):
+    # Fletcher-32 checksum of a sequence of 16-bit counts, as computed on the board while a compressed frame is sent
+    # s1 is the sum of the counts and s2 the sum of the running sums, both modulo 65535, worked out without a loop
+    # the counts are taken in the order they are sent, one channel after another
+
+    c = numpy.asarray(counts, dtype = numpy.int64).ravel()
+    c = c % 0xFFFF
+    weights = (numpy.arange(len(c), 0, -1, dtype = numpy.int64)) % 0xFFFF
+    s1 = int(numpy.sum(c) % 0xFFFF)
+    s2 = int(numpy.sum((c * weights) % 0xFFFF) % 0xFFFF)
+    return (s2 << 16) | s1
+
+def Decode_Varints(payload):
+    # all of the unsigned varints, 7 bits per byte with the top bit set on all but the last byte, in payload as an array
+
+    b = numpy.frombuffer(payload, dtype = numpy.uint8)
+    ends = numpy.flatnonzero(b < 0x80)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    pos = numpy.arange(len(b)) - numpy.repeat(starts, ends - starts + 1)
+    return numpy.add.reduceat((b & 0x7F).astype(numpy.int64) << (7 * pos), starts) if len(ends) > 0 else numpy.zeros(0, dtype = numpy.int64)
+
+def Decode_Encoded_Frame(header, payload, checksum):
+    # convert a compressed frame from Measurement.write_encoded_frame into an array of raw counts, as Decode_Frame does
+    # the varints are unpacked, the zero runs expanded and the differences summed along each channel, all without a Python loop
+
+    FUNC_NAME = ".Decode_Encoded_Frame()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        start, mask, n_samples, shift = struct.unpack(ENCODED_HEADER, header)
+        n_channels = Channel_Count(mask)
+        tokens = Decode_Varints(payload)
+        # every zero is a marker and the token after it is the length of a run of zero differences, which is never zero
+        marker = tokens == 0
+        is_run = numpy.concatenate(([False], marker[:-1]))
+        keep = ~marker
+        zigzag = tokens[keep]
+        run = is_run[keep]
+        diffs = numpy.where(run, 0, (zigzag >> 1) ^ -(zigzag & 1))
+        diffs = numpy.repeat(diffs, numpy.where(run, zigzag, 1))
+        if start == encodedStartStr and len(diffs) == n_samples * n_channels:
+            by_channel = (numpy.cumsum(diffs.reshape(n_channels, n_samples), axis = 1) << shift).astype('<u2')
+            if Fletcher32(by_channel) == checksum:
+                return numpy.ascontiguousarray(by_channel.T)
+            ERR_STATEMENT = ERR_STATEMENT + "\nChecksum does not match, the frame was corrupted"
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nFrame header does not match payload"
+        raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Read_Encoded_Payload(instr):
+    # read the chunks of a compressed frame that follow its header, returns the payload and the checksum
+
+    chunks = []
+    n_bytes = struct.unpack('<H', instr.read_bytes(2))[0]
+    while n_bytes > 0:
+        # the length of the next chunk is read along with this one
+        chunk = instr.read_bytes(n_bytes + 2)
+        chunks.append(chunk[:-2])
+        n_bytes = struct.unpack('<H', chunk[-2:])[0]
+    return b''.join(chunks), struct.unpack('<I', instr.read_bytes(4))[0]
+
+def Read_Frame(instr, lines = None):
+    # read one binary frame from an open instrument, raw or compressed
+    # anything that arrives before the frame start byte, e.g. the echo of the command, is discarded
+    # if the instrument can peek at what comes next, e.g. a Transport, the text before the frame is read a line at a time
+    # and kept in lines, if given; a line starting with replyEndStr means the board replied without a frame, e.g. with an error,
+    # then None is returned straight away and the terminator is left for Session.read_reply
+
+    FUNC_NAME = ".Read_Frame()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        if hasattr(instr, 'peek'):
+            start = instr.peek(1)
+            while start != frameStartStr and start != encodedStartStr:
+                if start == replyEndStr.encode('ascii'):
+                    return None
+                line = instr.read().strip()
+                if line and lines is not None:
+                    lines.append(line)
+                start = instr.peek(1)
+        start = instr.read_bytes(1)
+        while start != frameStartStr and start != encodedStartStr:
+            start = instr.read_bytes(1)
+        if start == encodedStartStr:
+            header = start + instr.read_bytes(ENCODED_HEADER_SIZE - 1)
+            payload, checksum = Read_Encoded_Payload(instr)
+            return Decode_Encoded_Frame(header, payload, checksum)
+        header = start + instr.read_bytes(FRAME_HEADER_SIZE - 1)
+        n_bytes = struct.unpack(FRAME_HEADER, header)[3]
+        payload = instr.read_bytes(n_bytes) if n_bytes > 0 else b''
+        return Decode_Frame(header, payload)
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Read_Stream_Frame(instr):
+    # read one streamed block from an open instrument, anything before the start byte is discarded
+    # returns the block sequence number, the time of its first sample in microseconds modulo US_WRAP
+    # and an array of raw counts with one row per sample and one column per channel
+
+    start = instr.read_bytes(1)
+    while start != streamStartStr:
+        start = instr.read_bytes(1)
+    header = start + instr.read_bytes(STREAM_HEADER_SIZE - 1)
+    start, mask, n_samples, n_bytes, seq, t_us = struct.unpack(STREAM_HEADER, header)
+    payload = instr.read_bytes(n_bytes) if n_bytes > 0 else b''
+    return seq, t_us, numpy.frombuffer(payload, dtype = '<u2').reshape(n_samples, Channel_Count(mask))
+
+def Read_Block(instr, n_samples, mask = ALL_CHANNELS):
+    # ask the board for n_samples raw counts on each channel in mask
+    # returns an array of raw counts with one row per sample and one column per channel
+
+    FUNC_NAME = ".Read_Block()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        if n_samples > 0 and Channel_Count(mask) > 0:
+            instr.write("%(v1)s%(v2)d,%(v3)d"%{"v1":readBlockStr, "v2":n_samples, "v3":mask})
+            return Read_Frame(instr)
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo channels or samples requested"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Parse_Reading(line, n_values = N_CHANNELS):
+    # convert a line of space separated voltages, e.g. the reply to readAngStr, into a list of floats
+    # returns None if the line is not a reading, e.g. it is the echo of a command
+
+    vals = line.split()
+    if len(vals) == n_values:
+        try:
+            return [float(v) for v in vals]
+        except ValueError:
+            return None
+    return None
+
+def Parse_Channels(line):
+    # convert a reply to readAngStr into the list of voltages at Vin1 .. Vin5 and the no. samples averaged for each of them
+    # the no. samples only follows the voltages when the board is oversampling, see Session.oversample
+    # returns None, None if the line is not a reading
+
+    vals = Parse_Reading(line, N_CHANNELS)
+    if vals is not None:
+        return vals, 1
+    vals = Parse_Reading(line, N_CHANNELS + 1)
+    if vals is not None:
+        return vals[:N_CHANNELS], int(vals[N_CHANNELS])
+    return None, None
+
+class Checked_Instrument(object):
+    # Wraps an open instrument and keeps the CRC-32 of everything read from it since the last reset
+    # so that it can be compared with the CRC the board puts on the terminator of a checked reply, see Measurement.seqStr
+    # text lines are counted as the board printed them, with a single newline at the end
+    # everything else is passed straight through to the instrument, including setting attributes such as timeout
+
+    def __init__(self, instr):
+        object.__setattr__(self, 'instr', instr)
+        object.__setattr__(self, 'crc', 0)
+        object.__setattr__(self, 'last_crc', 0) # the CRC before the last read, i.e. up to the start of the reply terminator
+
+    def __getattr__(self, name):
+        return getattr(self.instr, name)
+
+    def __setattr__(self, name, value):
+        if name in ('crc', 'last_crc'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.instr, name, value)
+
+    def reset(self):
+        self.crc = 0
+        self.last_crc = 0
+
+    def read(self):
+        line = self.instr.read()
+        self.last_crc = self.crc
+        self.crc = binascii.crc32((line.rstrip('\r') + '\n').encode('ascii', 'replace'), self.crc)
+        return line
+
+    def read_bytes(self, count):
+        data = self.instr.read_bytes(count)
+        self.last_crc = self.crc
+        self.crc = binascii.crc32(data, self.crc)
+        return data
+
+class Session(object):
+    # Keep a single VISA connection to a board open for as many write / read calls as needed
+    # The resource is opened, and the terminations configured, once when the session is created
+    # rather than once per measurement
+    # Use as a context manager so that the device is always closed
+    #   with MicroController.Session() as dev:
+    #       dev.set_voltage(1.5)
+    #       print(dev.read_channels())
+
+    def __init__(self, address = None, timeout = READ_TIMEOUT, rm = None, query_mode = True, checked = False, retries = RETRIES,
+                 backend = Transport.VISA, baud = Transport.BAUD, buffer_size = Transport.BUFFER_SIZE):
+        # address is the VISA address or serial port of the device, first device found is used if none is given
+        # timeout is the time in milliseconds a read will wait before giving up
+        # backend is how the device is reached, serial, visa, loopback or auto for the faster of serial and visa, see Transport
+        # baud and buffer_size are passed on to the backend, rm is the resource manager for visa, or a Simulator.ResourceManager
+        # query_mode switches on the reply terminator in the firmware, see query()
+        # checked = True sends every command with a sequence no. and checks the reply against it and its CRC, see request()
+        # a bad reply is asked for again up to retries times, needs query_mode
+
+        FUNC_NAME = ".Session.__init__()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        self.instr = None
+        self.n_averaged = 1 # samples averaged for each voltage in the last reply to read_channels, read_block or sweep
+        self.checked = False
+        self.retries = retries
+        self.seq = 0
+        self.resends = 0 # no. commands sent again because of a bad reply
+        self.last_end = None # terminator of the last reply
+        try:
+            if address is None:
+                resources = Transport.List(Transport.VISA if backend == Transport.AUTO else backend, rm)
+                if resources:
+                    address = resources[0]
+                else:
+                    ERR_STATEMENT = ERR_STATEMENT + "\nNo devices connected"
+                    raise Exception
+            self.address = address
+            self.instr = Transport.Open(address, backend, timeout, baud, buffer_size, rm)
+            self.backend = self.instr.backend
+            self.query_mode = False
+            time.sleep(DELAY) # opening the port can reset the board, give it time to come back, once per session
+            if query_mode:
+                # anything left over in the buffer from before is read and discarded along with the first reply
+                self.query_mode = True
+                self.query(queryModeStr + '1')
+                if checked:
+                    self.instr = Checked_Instrument(self.instr)
+                    self.checked = True
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_open(self):
+        # True if the connection to the device is available
+        return self.instr is not None
+
+    def write(self, cmd_str):
+        # send a command to the device
+        self.instr.write(cmd_str)
+
+    def read(self):
+        # read one line from the device, line endings removed
+        return self.instr.read().strip()
+
+    def read_reply(self, cmd_str = None):
+        # read lines from the device until the reply terminator arrives
+        # the echo of cmd_str, if the board echoes commands back, is dropped
+        # blocks only as long as the reply takes, a missing terminator raises a timeout after self.instr.timeout ms
+        # the terminator itself, which carries the sequence no. and CRC of a checked reply, is kept in self.last_end
+        reply = []
+        line = self.read()
+        while not line.startswith(replyEndStr):
+            if line and line != cmd_str:
+                reply.append(line)
+            line = self.read()
+        self.last_end = line
+        return reply
+
+    def request(self, cmd_str, reader = None):
+        # send cmd_str, or a list of commands as a batch, and read the reply, or the reply to each of them
+        # reader(self.instr, lines), if given, reads the binary part of a reply, e.g. Read_Frame, before the lines of text
+        # and adds any text it skips to lines, so that an error sent in place of the binary part ends up in the reply and is printed
+        # returns what reader returned, or None, and the list of lines in the reply, or a list of each for a batch
+        # on a checked session each command is sent as seqStr<seq>:<command> and whatever arrives before the start of its
+        # reply is skipped, so nothing needs to be flushed beforehand; a reply that times out, or has the wrong sequence no.
+        # or CRC, is thrown away and the command sent again, up to self.retries times
+
+        cmds = cmd_str if isinstance(cmd_str, list) else [cmd_str]
+        if not self.checked:
+            self.write(batchSepStr.join(cmds))
+            results = []
+            replies = []
+            for i in range(0, len(cmds), 1):
+                echo = batchSepStr.join(cmds) if i == 0 else None
+                skipped = []
+                result = reader(self.instr, skipped) if reader is not None else None
+                reply = [line for line in skipped if line != echo] + (self.read_reply(echo) if self.query_mode else [])
+                self.report_missing(reader, result, reply)
+                results.append(result)
+                replies.append(reply)
+            return (results, replies) if isinstance(cmd_str, list) else (results[0], replies[0])
+
+        for attempt in range(0, self.retries + 1, 1):
+            tags = []
+            for cmd in cmds:
+                self.seq = (self.seq + 1) % SEQ_WRAP
+                tags.append(seqStr + str(self.seq))
+            try:
+                self.write(batchSepStr.join(tag + ':' + cmd for tag, cmd in zip(tags, cmds)))
+                results = []
+                replies = []
+                good = True
+                for tag in tags:
+                    line = self.read()
+                    while line != tag: # the echo of the command, or what is left of an earlier reply
+                        line = self.read()
+                    self.instr.reset()
+                    skipped = []
+                    result = reader(self.instr, skipped) if reader is not None else None
+                    reply = skipped + self.read_reply()
+                    # a reply with a good CRC and no binary part is what the board sent, e.g. an error, and is not asked for again
+                    good = good and self.last_end == "%(v1)s%(v2)s %(v3)d"%{"v1":replyEndStr, "v2":tag[1:], "v3":self.instr.last_crc}
+                    results.append(result)
+                    replies.append(reply)
+                if good:
+                    for result, reply in zip(results, replies):
+                        self.report_missing(reader, result, reply)
+                    return (results, replies) if isinstance(cmd_str, list) else (results[0], replies[0])
+            except Exception:
+                pass # a timeout, or a frame that could not be read, is dealt with in the same way as a bad CRC
+            self.resends = self.resends + 1
+            self.instr.clear() # drop what has arrived of the bad reply, anything still on its way is skipped by the next request
+        raise Exception("No good reply to " + str(cmd_str) + " after %(v1)d attempts"%{"v1":self.retries + 1})
+
+    def report_missing(self, reader, result, reply):
+        # print the reply to a command whose binary part could not be read, it holds the reason the board gave, if any
+        if reader is not None and result is None:
+            for line in reply:
+                print(line)
+
+    def query(self, cmd_str):
+        # send a command and return the list of lines in the reply
+        # in query mode this waits for the reply terminator, otherwise a single line is read
+        if self.checked:
+            return self.request(cmd_str)[1]
+        self.write(cmd_str)
+        if self.query_mode:
+            return self.read_reply(cmd_str)
+        else:
+            line = self.read()
+            return [line] if line != cmd_str else [self.read()]
+
+    def query_batch(self, cmds):
+        # send a list of commands in one write and return the list of reply lines for each of them
+        # the board runs the commands in order, so the USB round trip is paid once for the whole batch
+        # needs query mode, the reply terminators are what separate the replies
+
+        FUNC_NAME = ".Session.query_batch()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if self.query_mode:
+                # the echo of the batch, if there is one, arrives before the first reply
+                return self.request(list(cmds))[1]
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nBatched commands need query mode"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def identify(self):
+        # ask the board what it is, returns a dictionary with the fields in IDN_FIELDS
+        # or None if the board does not answer, e.g. it is not running Measurement
+        # outside query mode there is no reply terminator, the echo is skipped and the next line is taken as the reply
+
+        FUNC_NAME = ".Session.identify()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if self.query_mode:
+                reply = self.query(identifyStr)
+            else:
+                self.write(identifyStr)
+                line = self.read()
+                while line in ('', identifyStr):
+                    line = self.read()
+                reply = [line]
+            for line in reply:
+                vals = line.split(',')
+                if len(vals) == len(IDN_FIELDS) and vals[0] == IDN_MAKER: # any other five fields are not from Measurement
+                    return dict(zip(IDN_FIELDS, vals))
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo identification returned by device"
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def set_voltage(self, volt):
+        # set the analog output from DCPINA to volt
+        # the board sets the output to zero if volt is outside the range [0, Vmax)
+
+        FUNC_NAME = ".Session.set_voltage()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if volt >= 0.0 and volt < Vmax:
+                cmd_str = "%(v1)s%(v2)0.4f"%{"v1":writeAngStrA, "v2":volt}
+                if self.query_mode:
+                    self.query(cmd_str) # wait for the board to acknowledge the write
+                else:
+                    self.write(cmd_str)
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nVoltage must be in the range [0, %(v1)0.1f)"%{"v1":Vmax}
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def set_averaged(self, reply):
+        # keep the no. samples averaged for each count given in the reply to readBlockStr or sweepCmdStr, if there is one
+        for line in reply:
+            vals = Parse_Reading(line, 1)
+            if vals is not None:
+                self.n_averaged = int(vals[0])
+
+    def read_channels(self):
+        # read the voltages at Vin1 .. Vin5
+        # lines that are not readings, e.g. the echo of the command, are skipped
+
+        FUNC_NAME = ".Session.read_channels()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            for line in self.query(readAngStr):
+                vals, n_avg = Parse_Channels(line)
+                if vals is not None:
+                    self.n_averaged = n_avg
+                    return numpy.array(vals)
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo reading returned by device"
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def set_and_read(self, volt, n_reads = 1):
+        # set the analog output to volt and read Vin1 .. Vin5 n_reads times, all in a single batch
+        # returns an array with one row per reading
+
+        FUNC_NAME = ".Session.set_and_read()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if volt >= 0.0 and volt < Vmax:
+                cmds = ["%(v1)s%(v2)0.4f"%{"v1":writeAngStrA, "v2":volt}] + [readAngStr] * n_reads
+                replies = self.query_batch(cmds)
+                readings = [Parse_Channels(reply[0])[0] for reply in replies[1:] if reply]
+                if len(readings) == n_reads and None not in readings:
+                    return numpy.array(readings)
+                ERR_STATEMENT = ERR_STATEMENT + "\nIncomplete readings returned by device"
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nVoltage must be in the range [0, %(v1)0.1f)"%{"v1":Vmax}
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def oversample(self, n_samples = None, bits = None):
+        # set the no. samples the board averages for each reading on readAngStr and readBlockStr, needs Measurement.Cuffe_Iface
+        # the average keeps bits extra bits of resolution, by default one for each factor of 4 in n_samples
+        # n_samples = None only reports the setting, n_samples = 1 switches oversampling off
+        # returns the no. samples and extra bits in use on the board
+
+        FUNC_NAME = ".Session.oversample()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if n_samples is None:
+                cmd_str = oversampleCmdStr + '?'
+            else:
+                cmd_str = "%(v1)s%(v2)d,%(v3)d"%{"v1":oversampleCmdStr, "v2":n_samples, "v3":-1 if bits is None else bits}
+            reply = self.query(cmd_str)
+            for line in reply:
+                vals = Parse_Reading(line, 2)
+                if vals is not None:
+                    return int(vals[0]), int(vals[1])
+            ERR_STATEMENT = ERR_STATEMENT + "\n" + '\n'.join(reply)
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def encoding(self, encoding = None):
+        # set the encoding of the binary frames sent by the board, ENCODE_RAW or ENCODE_DELTA, encoding = None only reports it
+        # compressed frames are decoded by Read_Frame, so the methods that read frames work the same with either
+        # returns the encoding in use on the board
+
+        FUNC_NAME = ".Session.encoding()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            reply = self.query(encodeCmdStr + ('?' if encoding is None else "%(v1)d"%{"v1":encoding}))
+            for line in reply:
+                vals = Parse_Reading(line, 1)
+                if vals is not None:
+                    return int(vals[0])
+            ERR_STATEMENT = ERR_STATEMENT + "\n" + '\n'.join(reply)
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def read_block(self, n_samples, mask = ALL_CHANNELS):
+        # read n_samples raw counts from each channel in mask as an array, see Read_Block
+        # in query mode the no. samples the board averaged for each count follows the frame and is kept in self.n_averaged
+        if n_samples > 0 and Channel_Count(mask) > 0:
+            counts, reply = self.request("%(v1)s%(v2)d,%(v3)d"%{"v1":readBlockStr, "v2":n_samples, "v3":mask}, Read_Frame)
+            self.set_averaged(reply)
+            return counts
+        return Read_Block(self.instr, n_samples, mask) # reports the error
+
+    def drain(self):
+        # read and discard everything up to the end of the current reply, binary frames included
+        # in query mode this stops at the reply terminator and returns the lines of text in the reply,
+        # otherwise whatever has arrived is cleared and there are no lines
+        if self.query_mode:
+            lines = []
+            line = b''
+            while True:
+                byte = self.instr.read_bytes(1)
+                if not line and byte == encodedStartStr:
+                    self.instr.read_bytes(ENCODED_HEADER_SIZE - 1)
+                    Read_Encoded_Payload(self.instr)
+                elif not line and byte in (frameStartStr, streamStartStr):
+                    # skip over a frame, the payload length is the fourth field in both headers
+                    fmt = FRAME_HEADER if byte == frameStartStr else STREAM_HEADER
+                    header = byte + self.instr.read_bytes(struct.calcsize(fmt) - 1)
+                    n_bytes = struct.unpack(fmt, header)[3]
+                    if n_bytes > 0:
+                        self.instr.read_bytes(n_bytes)
+                elif byte == b'\n':
+                    line = line.strip().decode('ascii', 'replace')
+                    if line.startswith(replyEndStr):
+                        return lines
+                    if line:
+                        lines.append(line)
+                    line = b''
+                else:
+                    line = line + byte
+        else:
+            time.sleep(DELAY)
+            self.instr.clear()
+            return []
+
+    def stream(self, n_samples = 256, mask = (1 << 1), n_blocks = None, rate = 0.0, timestamps = False):
+        # generator that yields blocks of n_samples raw counts from each channel in mask as they arrive, needs Measurement.AC_Read
+        # the board samples continuously, so consecutive blocks follow on from each other
+        # rate > 0 paces the samples on the board to rate Hz, otherwise they are taken as fast as the board can
+        # timestamps = True yields (t, counts) instead, t the time of the first sample in the block in seconds from the first block
+        # runs for n_blocks blocks, or until the generator is closed if n_blocks is None
+        #   for counts in dev.stream(512, 0b11):
+        #       process(counts)
+        # the no. of blocks lost in transit is kept in self.stream_gaps
+        # in query mode the timing of a paced stream, a dictionary with the fields in TIMING, is kept in self.stream_timing
+
+        FUNC_NAME = ".Session.stream()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        self.stream_gaps = 0
+        self.stream_timing = None
+        try:
+            if Channel_Count(mask) > 0 and n_samples > 0:
+                self.write("%(v1)s%(v2)d,%(v3)d,%(v4)r"%{"v1":streamCmdStr, "v2":n_samples, "v3":mask, "v4":float(rate)})
+                try:
+                    count = 0
+                    expected = 0
+                    t_first = None
+                    t_last = 0
+                    t_wraps = 0
+                    while n_blocks is None or count < n_blocks:
+                        seq, t_us, counts = Read_Stream_Frame(self.instr)
+                        if seq != expected:
+                            self.stream_gaps = self.stream_gaps + (seq - expected)
+                        expected = seq + 1
+                        count = count + 1
+                        if timestamps:
+                            # unwrap the 32-bit microsecond clock, blocks are never more than one wrap apart
+                            if t_us < t_last:
+                                t_wraps = t_wraps + 1
+                            t_last = t_us
+                            t_us = t_us + t_wraps * US_WRAP
+                            if t_first is None:
+                                t_first = t_us
+                            yield (t_us - t_first) * 1.0e-6, counts
+                        else:
+                            yield counts
+                finally:
+                    # any command stops the stream, the blocks still in flight are discarded
+                    self.write(streamCmdStr)
+                    for line in self.drain():
+                        vals = Parse_Reading(line, len(TIMING))
+                        if vals is not None:
+                            self.stream_timing = dict(zip(TIMING, vals))
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNo channels or samples requested"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def stats(self, n_samples = 500, mask = (1 << 1), stat_mask = ALL_STATS):
+        # statistics of n_samples readings of each channel in mask, computed on the board, needs Measurement.AC_Max
+        # stat_mask selects from STATS, bit k selects STATS[k]
+        # returns a dictionary keyed by statistic name, each entry has one value per channel, in volts except for the count
+
+        FUNC_NAME = ".Session.stats()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            names = [STATS[k] for k in range(0, len(STATS), 1) if stat_mask & (1 << k)]
+            n_channels = Channel_Count(mask)
+            if n_channels > 0 and len(names) > 0 and n_samples > 0:
+                cmd_str = "%(v1)s%(v2)d,%(v3)d,%(v4)d"%{"v1":statsCmdStr, "v2":n_samples, "v3":mask, "v4":stat_mask}
+                for line in self.query(cmd_str):
+                    vals = Parse_Reading(line, n_channels * len(names))
+                    if vals is not None:
+                        vals = numpy.array(vals).reshape(n_channels, len(names))
+                        return dict((names[k], vals[:, k]) for k in range(0, len(names), 1))
+                ERR_STATEMENT = ERR_STATEMENT + "\nNo statistics returned by device"
+                raise Exception
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNo channels, statistics or samples requested"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def capture(self, n_samples = 0, mask = (1 << 1)):
+        # capture n_samples raw counts from each channel in mask into the board's preallocated buffer, needs Measurement.AC_Read
+        # n_samples = 0 fills the buffer on the board
+        # returns an array of raw counts with one row per sample and one column per channel
+
+        FUNC_NAME = ".Session.capture()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if Channel_Count(mask) > 0:
+                return self.request("%(v1)s%(v2)d,%(v3)d"%{"v1":captureCmdStr, "v2":max(0, n_samples), "v3":mask}, Read_Frame)[0]
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNo channels requested"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def paced_capture(self, rate, n_samples = 1000, mask = (1 << 1)):
+        # capture n_samples raw counts from each channel in mask with the board pacing the samples to rate Hz, needs Measurement.AC_Read
+        # returns the array of raw counts, one row per sample, and a dictionary with the fields in TIMING,
+        # the achieved rate and how late the samples were taken relative to the schedule
+
+        FUNC_NAME = ".Session.paced_capture()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if rate > 0.0 and Channel_Count(mask) > 0:
+                cmd_str = "%(v1)s%(v2)r,%(v3)d,%(v4)d"%{"v1":rateCmdStr, "v2":float(rate), "v3":n_samples, "v4":mask}
+                read_timeout = self.instr.timeout
+                self.instr.timeout = read_timeout + 1000.0 * n_samples / rate
+                try:
+                    counts, reply = self.request(cmd_str, Read_Frame)
+                    if not self.query_mode:
+                        reply = [self.read()] # the timing line follows the frame
+                finally:
+                    self.instr.timeout = read_timeout
+                timing = None
+                for line in reply:
+                    vals = Parse_Reading(line, len(TIMING))
+                    if vals is not None:
+                        timing = dict(zip(TIMING, vals))
+                return counts, timing
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNeed rate > 0 and at least one channel"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def gc_capture(self, n_samples = 0, mask = (1 << 1)):
+        # capture n_samples raw counts from each channel in mask with the garbage collector on the board switched off, needs Measurement.AC_Read
+        # zero samples, or more than the board can hold, fills its capture buffer
+        # returns the array of raw counts, one row per sample, and a dictionary with the fields in GC_REPORT,
+        # the achieved rate, the largest gap between samples in ms, the no. of stalls, the free heap and the bytes allocated while sampling
+
+        FUNC_NAME = ".Session.gc_capture()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if Channel_Count(mask) > 0:
+                counts, reply = self.request("%(v1)s%(v2)d,%(v3)d"%{"v1":gcCaptureCmdStr, "v2":max(0, n_samples), "v3":mask}, Read_Frame)
+                if not self.query_mode:
+                    reply = [self.read()] # the report follows the frame
+                report = None
+                for line in reply:
+                    vals = Parse_Reading(line, len(GC_REPORT))
+                    if vals is not None:
+                        report = dict(zip(GC_REPORT, vals))
+                return counts, report
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNeed at least one channel"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def trigger_capture(self, n_pre = 100, n_post = 400, mask = (1 << 1), channel = 1, level = 1.0, edge = 1, timeout = 1.0):
+        # wait for channel (0 for Vin1, ..., 4 for Vin5) to cross level volts at the pin and capture the window around it, needs Measurement.AC_Read
+        # edge > 0 triggers on a rising crossing, edge < 0 on a falling one and edge = 0 on either
+        # the board keeps sampling into a ring buffer and only sends n_pre rows before the trigger and n_post rows from it on
+        # returns an array of raw counts with one row per sample and one column per channel in mask, the trigger channel is always included
+        # returns None if nothing triggers within timeout seconds
+
+        FUNC_NAME = ".Session.trigger_capture()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if channel >= 0 and channel < N_CHANNELS and n_pre >= 0 and n_post > 0 and timeout > 0.0:
+                cmd_str = "%(v1)s%(v2)d,%(v3)d,%(v4)d,%(v5)d,%(v6)0.4f,%(v7)d,%(v8)0.3f"%{"v1":triggerCmdStr, "v2":n_pre, "v3":n_post,
+                          "v4":mask, "v5":channel, "v6":level, "v7":edge, "v8":timeout}
+                # the reply only comes once the trigger fires or the board gives up
+                read_timeout = self.instr.timeout
+                self.instr.timeout = read_timeout + 1000.0 * timeout
+                try:
+                    counts = self.request(cmd_str, Read_Frame)[0]
+                finally:
+                    self.instr.timeout = read_timeout
+                return counts if counts is not None and counts.shape[0] > 0 else None
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nNeed channel in [0, %(v1)d), n_pre >= 0, n_post > 0 and timeout > 0"%{"v1":N_CHANNELS}
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def calibration(self, refresh = False, max_age = None):
+        # the calibration cached on the board, needs Measurement.Cuffe_Iface
+        # refresh = True makes the board measure it again, max_age sets how old in seconds it may get before the board re-measures it
+        # returns a dictionary with the age in seconds, and the offset and divider gain of each of Vin1 .. Vin5
+
+        FUNC_NAME = ".Session.calibration()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if refresh:
+                cmd_str = calCmdStr
+            elif max_age is not None:
+                cmd_str = "%(v1)s%(v2)0.1f"%{"v1":calCmdStr, "v2":max_age}
+            else:
+                cmd_str = calCmdStr + '?'
+            for line in self.query(cmd_str):
+                vals = Parse_Reading(line, 1 + 2 * N_CHANNELS)
+                if vals is not None:
+                    return {'age':vals[0], 'offset':numpy.array(vals[1:1 + N_CHANNELS]), 'gain':numpy.array(vals[1 + N_CHANNELS:])}
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo calibration returned by device"
+            raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def sweep(self, start, stop, step, settle = 0.01, n_reads = 1, mask = ALL_CHANNELS):
+        # step the analog output from start to stop inclusive, the sweep runs on the board
+        # at each set point the board waits settle seconds and takes n_reads readings of each channel in mask
+        # returns an array with one row per reading, first column is the set voltage, then one column per channel in volts
+
+        FUNC_NAME = ".Session.sweep()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            # the board only sees the values as sent, to 4 decimal places, so the set points are worked out from those
+            # otherwise the two ends can disagree on the no. points
+            args = ["%(v1)0.4f"%{"v1":x} for x in (start, stop, step)]
+            start, stop, step = [float(x) for x in args]
+            Vset = Sweep_Points(start, stop, step)
+            if Channel_Count(mask) > 0 and n_reads * Channel_Count(mask) > MAX_BLOCK:
+                # the board would send fewer readings per point than asked for and the table would not line up with Vset
+                ERR_STATEMENT = ERR_STATEMENT + "\nAt most %(v1)d readings per point for %(v2)d channels"%{"v1":MAX_BLOCK // Channel_Count(mask), "v2":Channel_Count(mask)}
+                raise Exception
+            if len(Vset) > 0 and n_reads > 0 and Channel_Count(mask) > 0:
+                # the board waits settle seconds per point, allow for that on top of the usual timeout
+                timeout = self.instr.timeout
+                self.instr.timeout = timeout + 1000.0 * settle * len(Vset)
+                cmd_str = "%(v1)s%(v2)s,%(v3)0.4f,%(v4)d,%(v5)d"%{"v1":sweepCmdStr, "v2":','.join(args), "v3":settle, "v4":n_reads, "v5":mask}
+                def read_table(instr, lines):
+                    # one frame per set point, None if any of them could not be read
+                    table = [Read_Frame(instr, lines) for k in range(0, len(Vset), 1)]
+                    return None if any(frame is None for frame in table) else table
+                try:
+                    table, reply = self.request(cmd_str, read_table)
+                finally:
+                    self.instr.timeout = timeout
+                self.set_averaged(reply)
+                volts = Counts_To_Volts(numpy.concatenate(table))
+                return numpy.column_stack((numpy.repeat(Vset, n_reads), volts))
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nSweep must have step > 0, stop >= start and at least one reading and channel"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def constant_current(self, target, kp = None, ki = None, tol = None, n_report = 100, duration = 0.0):
+        # generator that runs the constant current mode on the board, needs Measurement.Cuffe_Iface
+        # the board holds the current through R3 at target mA with a PI loop on the analog output and yields a dictionary
+        # with the fields in CC_FIELDS every n_report loop iterations, current in mA averaged over those iterations
+        # kp, ki and tol default to the values on the board, see Measurement.regulate_current
+        # runs for duration seconds if duration > 0, otherwise until the generator is closed, the output is left where it is
+        #   for rep in dev.constant_current(20.0):
+        #       if rep['settled']: break
+
+        FUNC_NAME = ".Session.constant_current()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            if self.query_mode:
+                # plain numbers, repr of a numpy scalar such as numpy.float64(20.0) is not something the board can parse
+                args = ['' if a is None else "%(v1)r"%{"v1":float(a)} for a in (target, kp, ki, tol)]
+                args = args + ["%(v1)d"%{"v1":n_report}, "%(v1)r"%{"v1":float(duration)}]
+                cmd_str = currentCmdStr + ','.join(args)
+                self.write(cmd_str)
+                finished = False
+                try:
+                    line = self.read()
+                    while line != replyEndStr:
+                        vals = Parse_Reading(line, len(CC_FIELDS))
+                        if vals is not None:
+                            rep = dict(zip(CC_FIELDS, vals))
+                            rep['settled'] = rep['settled'] > 0.0
+                            yield rep
+                        elif line and line != cmd_str:
+                            print(line) # the board reported an error
+                        line = self.read()
+                    finished = True
+                finally:
+                    if not finished:
+                        # any line stops the loop, the reports still in flight are discarded
+                        # a lone batchSepStr is used as it gets no reply at all if the loop has already ended by itself,
+                        # so there is exactly one reply terminator to drain either way
+                        self.write(batchSepStr)
+                        self.drain()
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nConstant current mode needs query mode"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def set_current(self, target, timeout = 5.0, **kwargs):
+        # run the constant current mode until the current settles at target mA, then leave the output where it is
+        # returns the report at which it settled, or None if it has not settled after timeout seconds
+        # kwargs are passed on to constant_current
+        reports = self.constant_current(target, duration = timeout, **kwargs)
+        try:
+            for rep in reports:
+                if rep['settled']:
+                    return rep
+            return None
+        finally:
+            reports.close()
+
+    def close(self):
+        # close the connection to the device
+        # if this session switched query mode on it is switched off again, so that the board answers LabVIEW as before
+        if self.instr is not None:
+            try:
+                if self.query_mode:
+                    self.write(queryModeStr + '0') # nothing comes back, the board stops sending the terminator as of this reply
+                    self.query_mode = False
+            finally:
+                self.instr.close()
+                self.instr = None
+
+class Calibration(object):
+    # Calibration model for the current source measurements, held on the PC
+    # The board sends raw counts, this turns whole arrays of them into corrected voltages and the derived
+    # quantities of Measurement.Current_Source_Measurement in one vectorised pass
+    #   cal = Calibration()
+    #   cal.update(dev.calibration())
+    #   results = cal.derived(dev.read_block(1000))
+    # Resistances are in kOhm so currents come out in mA
+
+    def __init__(self, offset = None, gain = None, R1 = (54.9/1000.0), R2 = (10.3/1000.0), R3 = (4.8/1000.0), Rload = (10.0/1000.0)):
+        # offset and gain have one entry for each of Vin1 .. Vin5
+        # by default there is no offset, Vin1 is read directly and Vin2 .. Vin5 are behind 5/3 voltage-dividers
+        Vscale = (5.0/3.0)
+        self.offset = numpy.zeros(N_CHANNELS) if offset is None else numpy.asarray(offset, dtype = float)
+        self.gain = numpy.array([1.0, Vscale, Vscale, Vscale, Vscale]) if gain is None else numpy.asarray(gain, dtype = float)
+        self.R1 = R1
+        self.R2 = R2
+        self.R3 = R3
+        self.Rload = Rload
+
+    def update(self, cal):
+        # take the offsets and gains from the board, i.e. from Session.calibration()
+        if cal is not None:
+            self.offset = numpy.asarray(cal['offset'], dtype = float)
+            self.gain = numpy.asarray(cal['gain'], dtype = float)
+
+    def volts(self, counts, mask = ALL_CHANNELS):
+        # offset corrected voltages at the pins for an array of raw counts with one column per channel in mask
+        # as on the board the offset is only subtracted when it is positive
+        cols = [i for i in range(0, N_CHANNELS, 1) if mask & (1 << i)]
+        offset = numpy.where(self.offset[cols] > 0.0, self.offset[cols], 0.0)
+        return Counts_To_Volts(counts) - offset
+
+    def real_volts(self, counts, mask = ALL_CHANNELS):
+        # voltages before the voltage-dividers, i.e. pin voltages multiplied by the divider gains
+        cols = [i for i in range(0, N_CHANNELS, 1) if mask & (1 << i)]
+        return self.volts(counts, mask) * self.gain[cols]
+
+    def derived(self, counts):
+        # all the quantities of Measurement.Current_Source_Measurement for an array of raw counts on all five channels
+        # returns a dictionary of arrays with one entry per reading
+
+        FUNC_NAME = ".Calibration.derived()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        try:
+            counts = numpy.atleast_2d(counts)
+            if counts.shape[1] == N_CHANNELS:
+                V = self.volts(counts)
+                ratio = self.R2 / (self.R1 * self.R3)
+                VR3 = V[:, 2] * self.gain[2] - V[:, 3] * self.gain[3]
+                Iload = V[:, 0] * ratio
+                return {'Vset':V[:, 0], 'Vctrl':V[:, 1] * self.gain[1], 'VR3':VR3, 'IR3':VR3 / self.R3,
+                        'Iload_predicted':Iload, 'Vload_predicted':Iload * self.Rload, 'Vload':V[:, 4] * self.gain[4]}
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nCounts for all %(v1)d channels are needed"%{"v1":N_CHANNELS}
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+def Current_Source_Measurement(dev, n_samples = 100, cal = None):
+    # Host side version of Measurement.Current_Source_Measurement
+    # reads n_samples raw counts from all channels of an open Session in one frame and works out the derived quantities on the PC
+
+    FUNC_NAME = ".Current_Source_Measurement()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        if cal is None:
+            cal = Calibration()
+            cal.update(dev.calibration())
+        counts = dev.read_block(n_samples, ALL_CHANNELS)
+        if counts is not None:
+            return cal.derived(counts)
+        else:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNo readings returned by device"
+            raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+def Uniform_Samples(v, t):
+    # put readings v taken at times t, one row per sample, onto an evenly spaced time grid with the same no. samples and span
+    # returns the readings and the time step, readings that are already evenly spaced are returned unchanged
+
+    t = numpy.asarray(t, dtype = float)
+    v = numpy.asarray(v, dtype = float)
+    dt = (t[-1] - t[0]) / (len(t) - 1)
+    if numpy.max(numpy.abs(numpy.diff(t) - dt)) <= UNIFORM_TOL * dt:
+        return v, dt
+    grid = t[0] + dt * numpy.arange(len(t))
+    if v.ndim == 1:
+        return numpy.interp(grid, t, v), dt
+    return numpy.column_stack([numpy.interp(grid, t, v[:, j]) for j in range(0, v.shape[1], 1)]), dt
+
+def Stream_Times(t_blocks, n_samples):
+    # time of every sample in a run of streamed blocks of n_samples rows, given the time of the first sample in each block
+    # the samples in each block are spread evenly up to the start of the next, the last block is spaced like the one before it
+
+    t_blocks = numpy.asarray(t_blocks, dtype = float)
+    dt_blocks = numpy.diff(t_blocks)
+    dt_blocks = numpy.append(dt_blocks, dt_blocks[-1] if len(dt_blocks) > 0 else 0.0)
+    return (t_blocks[:, None] + (dt_blocks / n_samples)[:, None] * numpy.arange(n_samples)[None, :]).ravel()
+
+def Analyse_Signal(v, dt = None, t = None, n_harmonics = N_HARMONICS):
+    # amplitude, RMS and dominant frequency of the AC signal in readings v, one row per sample and one column per channel
+    # the samples are dt seconds apart, or were taken at times t, in which case uneven timing is evened out first, see Uniform_Samples
+    # the frequency comes from the peak of a Hann windowed FFT, interpolated between bins by fitting a gaussian to the
+    # log magnitudes of the peak and its neighbours, the amplitude is corrected for where the peak falls between bins
+    # the THD is the power in harmonics 2 .. n_harmonics relative to the fundamental, each summed over the three bins of its peak
+    # returns a dictionary of arrays with one entry per channel, or of numbers if v is one-dimensional
+
+    FUNC_NAME = ".Analyse_Signal()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        v = numpy.asarray(v, dtype = float)
+        single = v.ndim == 1
+        v = v.reshape(v.shape[0], -1)
+        if t is not None:
+            v, dt = Uniform_Samples(v, t)
+        if dt is None or dt <= 0.0 or v.shape[0] < 8:
+            ERR_STATEMENT = ERR_STATEMENT + "\nNeed at least 8 samples and their time step or times"
+            raise Exception
+
+        n = v.shape[0]
+        cols = numpy.arange(v.shape[1])
+        mean = numpy.mean(v, axis = 0)
+        ac = v - mean
+        window = numpy.hanning(n)
+        P = numpy.abs(numpy.fft.rfft(ac * window[:, None], axis = 0))**2
+        n_bins = P.shape[0]
+
+        # peak bin, not DC and not the last bin so that both neighbours exist
+        k = 1 + numpy.argmax(P[1:n_bins - 1], axis = 0)
+        l0, l1, l2 = [0.5 * numpy.log(numpy.maximum(P[k + j, cols], 1.0e-300)) for j in (-1, 0, 1)]
+        curve = l0 - 2.0 * l1 + l2
+        delta = numpy.where(curve < 0.0, 0.5 * (l0 - l2) / numpy.where(curve < 0.0, curve, 1.0), 0.0)
+        delta = numpy.clip(delta, -0.5, 0.5)
+        # peak amplitude of a sine from its Hann windowed FFT, the window response falls off as sinc(d) / (1 - d^2) away from a bin
+        amplitude = 2.0 * numpy.exp(l1) / numpy.sum(window) / (numpy.sinc(delta) / (1.0 - delta**2))
+
+        fundamental = P[k - 1, cols] + P[k, cols] + P[k + 1, cols]
+        harmonics = numpy.zeros(len(cols))
+        for h in range(2, n_harmonics + 1, 1):
+            b = numpy.rint(h * (k + delta)).astype(int)
+            inside = b + 1 < n_bins
+            b = numpy.minimum(b, n_bins - 2)
+            harmonics = harmonics + numpy.where(inside, P[b - 1, cols] + P[b, cols] + P[b + 1, cols], 0.0)
+
+        results = {'mean':mean, 'rms':numpy.sqrt(numpy.mean(ac**2, axis = 0)), 'p2p':numpy.ptp(v, axis = 0), 'amplitude':amplitude,
+                   'frequency':(k + delta) / (n * dt), 'thd':numpy.sqrt(harmonics / numpy.maximum(fundamental, 1.0e-300)),
+                   'rate':numpy.full(len(cols), 1.0 / dt)}
+        if single:
+            results = dict((key, float(val[0])) for key, val in results.items())
+        return results
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+
+class Spectral_Monitor(object):
+    # Runs Analyse_Signal over streamed blocks as they arrive, in bounded memory
+    # the last n_fft samples are kept in a fixed size array and analysed each time another hop samples have arrived,
+    # only the last n_history analyses are kept, so a run can go on for hours
+    #   mon = Spectral_Monitor(4096, rate = 1000.0)
+    #   for t, counts in dev.stream(512, rate = 1000.0, timestamps = True):
+    #       res = mon.update(Counts_To_Volts(counts), t)
+    # without a rate the samples in each block are spread evenly up to the start of the next block, see Stream_Times,
+    # so each block is only analysed once the one after it has arrived, and every block must come with its time
+
+    def __init__(self, n_fft = 4096, hop = None, rate = None, n_history = 1000, n_harmonics = N_HARMONICS):
+        if rate is not None and rate <= 0.0:
+            raise ValueError("Spectral_Monitor needs rate > 0 Hz, or rate = None with the time of every block passed to update")
+        self.n_fft = n_fft
+        self.hop = hop if hop is not None else n_fft // 2
+        self.rate = rate
+        self.n_harmonics = n_harmonics
+        self.v = None
+        self.t = numpy.zeros(n_fft)
+        self.n_filled = 0
+        self.n_new = 0
+        self.n_samples = 0
+        self.pending = None
+        self.history = collections.deque(maxlen = n_history)
+
+    def update(self, v, t = None):
+        # add a block of readings v, one row per sample, whose first sample was taken at t seconds
+        # returns the latest analysis, with the time of the last sample in it, whenever one is made, otherwise None
+        v = numpy.asarray(v, dtype = float)
+        v = v.reshape(v.shape[0], -1)
+        if self.rate is not None:
+            t0 = t if t is not None else self.n_samples / self.rate
+            return self.push(v, t0 + numpy.arange(v.shape[0]) / self.rate)
+        if t is None:
+            raise ValueError("Spectral_Monitor has no rate, so update needs the time t of each block, e.g. from stream(..., timestamps = True)")
+        result = None
+        if self.pending is not None:
+            pv, pt = self.pending
+            result = self.push(pv, Stream_Times([pt, t], pv.shape[0])[:pv.shape[0]])
+        self.pending = (v, t)
+        return result
+
+    def push(self, v, times):
+        # shift the readings v taken at times into the analysis window
+        n = min(v.shape[0], self.n_fft)
+        if self.v is None or self.v.shape[1] != v.shape[1]:
+            self.v = numpy.zeros((self.n_fft, v.shape[1]))
+            self.n_filled = 0
+        self.v[:self.n_fft - n] = self.v[n:]
+        self.v[self.n_fft - n:] = v[-n:]
+        self.t[:self.n_fft - n] = self.t[n:]
+        self.t[self.n_fft - n:] = times[-n:]
+        self.n_filled = min(self.n_fft, self.n_filled + n)
+        self.n_new = self.n_new + v.shape[0]
+        self.n_samples = self.n_samples + v.shape[0]
+        if self.n_filled == self.n_fft and self.n_new >= self.hop:
+            self.n_new = 0
+            result = Analyse_Signal(self.v, t = self.t, n_harmonics = self.n_harmonics)
+            if result is not None:
+                result['time'] = self.t[-1]
+                self.history.append(result)
+            return result
+        return None
+
+    def trend(self):
+        # the analyses kept so far as a dictionary of arrays, one row per analysis and one column per channel
+        if len(self.history) == 0:
+            return {}
+        return dict((key, numpy.array([res[key] for res in self.history])) for key in self.history[0])
+
+def Query_Latency_Test(n_queries = 200, rm = None, address = None):
+    # Measure the round-trip time of terminated queries
+    # Pass Simulator.ResourceManager() as rm to run against the simulated board instead of hardware
+
+    FUNC_NAME = ".Query_Latency_Test()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        with Session(address, rm = rm) as dev:
+            if dev.is_open():
+                times = {writeAngStrA:[], readAngStr:[]}
+                for i in range(0, n_queries, 1):
+                    start_time = time.perf_counter()
+                    dev.set_voltage(Vmax * (i % 10) / 10.0)
+                    times[writeAngStrA].append(time.perf_counter() - start_time)
+
+                    start_time = time.perf_counter()
+                    dev.read_channels()
+                    times[readAngStr].append(time.perf_counter() - start_time)
+
+                for cmd_str in times:
+                    t = 1000.0 * numpy.array(times[cmd_str]) # convert to milliseconds
+                    print("Command %(v1)s: min %(v2)0.3f ms, median %(v3)0.3f ms, max %(v4)0.3f ms"%{"v1":cmd_str, "v2":numpy.min(t), "v3":numpy.median(t), "v4":numpy.max(t)})
+                return times
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nCould not open device"
+                raise Exception
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
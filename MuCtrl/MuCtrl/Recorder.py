@@ -0,0 +1,277 @@
+# This module writes acquisitions to disk as they arrive and reads them back
+# Each block of raw counts is appended straight to a chunked binary file, with the time of its first sample,
+# so a streaming run of any length uses the same small amount of memory and no time is spent formatting text
+# A recording is a directory holding
+#   counts.npy, the raw counts, one row per sample and one column per channel
+#   blocks.npy, one row per block with the time of its first sample, its first row in counts.npy, its no. rows and its sequence no.
+#   meta.json, the channel mask, sample rate, board identity and calibration
+# or, if h5py is installed and fmt = 'hdf5', a single .h5 file with the same datasets and the metadata as attributes
+# The .npy files are standard, the header is rewritten as blocks are appended, and can be opened with numpy.load(mmap_mode = 'r')
+#   with Recorder.Recorder('run1', mask = 0b10, rate = 1000.0) as rec:
+#       rec.record(dev.stream(512, 0b10, rate = 1000.0, timestamps = True))
+#   run = Recorder.Recording('run1')
+#   volts = run.volts(1000000, 1001000)
+
+MOD_NAME_STR = "Recorder"
+
+import os
+import json
+import time
+import struct
+import numpy
+
+import MicroController
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+NPY_HEADER_SIZE = 128 # bytes reserved for the .npy header, so it can be rewritten in place as the file grows
+BLOCK_FIELDS = ('time', 'row', 'n_rows', 'seq') # columns of blocks.npy
+FLUSH_BLOCKS = 64 # blocks between updates of the file headers, a recording cut short loses at most this many blocks
+CHUNK_ROWS = 4096 # rows per chunk of the HDF5 datasets
+
+def Npy_Header(dtype, shape):
+    # a version 1.0 .npy header for an array of dtype and shape padded to NPY_HEADER_SIZE bytes
+
+    text = repr({'descr':numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), 'fortran_order':False, 'shape':tuple(shape)})
+    n_pad = NPY_HEADER_SIZE - 10 - len(text) - 1
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', NPY_HEADER_SIZE - 10) + text.encode('latin1') + b' ' * n_pad + b'\n'
+
+class Npy_Appender(object):
+    # A .npy file that rows are appended to, only the no. rows is held in memory
+
+    def __init__(self, path, dtype, n_cols):
+        self.dtype = numpy.dtype(dtype)
+        self.n_cols = n_cols
+        self.n_rows = 0
+        self.f = open(path, 'wb+')
+        self.f.write(Npy_Header(self.dtype, (0, n_cols)))
+
+    def append(self, rows):
+        # add rows, an array with n_cols columns, to the end of the file
+        self.f.write(numpy.ascontiguousarray(rows, dtype = self.dtype).tobytes())
+        self.n_rows = self.n_rows + len(rows)
+
+    def flush(self):
+        # bring the header up to date so the file can be read as it stands
+        self.f.seek(0)
+        self.f.write(Npy_Header(self.dtype, (self.n_rows, self.n_cols)))
+        self.f.seek(0, os.SEEK_END)
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+class H5_Appender(object):
+    # An HDF5 dataset that rows are appended to, same interface as Npy_Appender
+
+    def __init__(self, h5, name, dtype, n_cols):
+        self.data = h5.create_dataset(name, shape = (0, n_cols), maxshape = (None, n_cols), dtype = dtype, chunks = (CHUNK_ROWS, n_cols))
+        self.n_rows = 0
+
+    def append(self, rows):
+        self.data.resize(self.n_rows + len(rows), axis = 0)
+        self.data[self.n_rows:] = rows
+        self.n_rows = self.n_rows + len(rows)
+
+    def flush(self):
+        self.data.file.flush()
+
+    def close(self):
+        pass
+
+def To_Json(obj):
+    # numpy values in the metadata as plain lists and numbers
+    return obj.tolist() if isinstance(obj, (numpy.ndarray, numpy.generic)) else str(obj)
+
+class Recorder(object):
+    # Appends blocks of raw counts and their timestamps to a recording on disk
+
+    def __init__(self, path, mask = (1 << 1), rate = None, cal = None, identity = None, fmt = 'npy', flush_blocks = FLUSH_BLOCKS):
+        # path is the directory for fmt = 'npy', or the file for fmt = 'hdf5'
+        # mask is the channel mask the counts were taken with, rate the sample rate in Hz if the board paced them
+        # cal is the calibration from Session.calibration(), identity the reply from Session.identify()
+
+        FUNC_NAME = ".Recorder.__init__()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        self.path = path
+        self.fmt = fmt
+        self.flush_blocks = flush_blocks
+        self.n_blocks = 0
+        self.h5 = None
+        self.counts = None
+        self.blocks = None
+        self.meta = {'mask':mask, 'rate':rate, 'calibration':cal, 'identity':identity, 'start':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'fields':BLOCK_FIELDS}
+        try:
+            n_channels = MicroController.Channel_Count(mask)
+            if fmt == 'hdf5':
+                if h5py is None:
+                    ERR_STATEMENT = ERR_STATEMENT + "\nh5py is needed for fmt = 'hdf5', pip install h5py"
+                    raise Exception
+                self.h5 = h5py.File(path, 'w')
+                self.h5.attrs['meta'] = json.dumps(self.meta, default = To_Json)
+                self.counts = H5_Appender(self.h5, 'counts', '<u2', n_channels)
+                self.blocks = H5_Appender(self.h5, 'blocks', '<f8', len(BLOCK_FIELDS))
+            elif fmt == 'npy':
+                os.makedirs(path, exist_ok = True)
+                with open(os.path.join(path, 'meta.json'), 'w') as f:
+                    json.dump(self.meta, f, indent = 2, default = To_Json)
+                self.counts = Npy_Appender(os.path.join(path, 'counts.npy'), '<u2', n_channels)
+                self.blocks = Npy_Appender(os.path.join(path, 'blocks.npy'), '<f8', len(BLOCK_FIELDS))
+            else:
+                ERR_STATEMENT = ERR_STATEMENT + "\nfmt must be 'npy' or 'hdf5'"
+                raise Exception
+        except Exception as e:
+            print(ERR_STATEMENT)
+            print(e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, counts, t = None, seq = None):
+        # add a block of raw counts, one row per sample, whose first sample was taken at t seconds
+        # without t the block is timed from its position in the recording and the sample rate, if there is one
+        counts = numpy.asarray(counts)
+        row = self.counts.n_rows
+        if t is None:
+            t = row / self.meta['rate'] if self.meta['rate'] else float('nan')
+        self.counts.append(counts.reshape(counts.shape[0], -1))
+        self.blocks.append([[t, row, counts.shape[0], self.n_blocks if seq is None else seq]])
+        self.n_blocks = self.n_blocks + 1
+        if self.n_blocks % self.flush_blocks == 0:
+            self.flush()
+
+    def record(self, blocks, n_blocks = None):
+        # append the blocks from a generator, e.g. Session.stream(..., timestamps = True), which yields (t, counts) or counts
+        # stops after n_blocks blocks if n_blocks is given, returns the no. blocks recorded
+        count = 0
+        for block in blocks:
+            if isinstance(block, tuple):
+                self.append(block[1], block[0])
+            else:
+                self.append(block)
+            count = count + 1
+            if n_blocks is not None and count >= n_blocks:
+                break
+        return count
+
+    def flush(self):
+        self.counts.flush()
+        self.blocks.flush()
+
+    def close(self):
+        if self.counts is not None:
+            self.counts.close()
+            self.blocks.close()
+            self.counts = None
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+class Recording(object):
+    # Read back a recording made by Recorder, the counts are memory-mapped, or read from the HDF5 file, a slice at a time
+
+    def __init__(self, path):
+        self.path = path
+        self.h5 = None
+        if os.path.isdir(path):
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                self.meta = json.load(f)
+            self.counts = numpy.load(os.path.join(path, 'counts.npy'), mmap_mode = 'r')
+            self.blocks = numpy.load(os.path.join(path, 'blocks.npy'), mmap_mode = 'r')
+        else:
+            self.h5 = h5py.File(path, 'r')
+            self.meta = json.loads(self.h5.attrs['meta'])
+            self.counts = self.h5['counts']
+            self.blocks = self.h5['blocks']
+        cal = self.meta.get('calibration')
+        self.cal = MicroController.Calibration() if cal is None else MicroController.Calibration(cal['offset'], cal['gain'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def n_blocks(self):
+        return self.blocks.shape[0]
+
+    def block(self, i):
+        # raw counts and start time of block i
+        t, row, n_rows, seq = self.blocks[i]
+        return self.counts[int(row):int(row) + int(n_rows)], t
+
+    def volts(self, start = 0, stop = None):
+        # offset corrected pin voltages of rows start to stop, see MicroController.Calibration.volts
+        return self.cal.volts(numpy.asarray(self.counts[start:stop]), self.meta['mask'])
+
+    def times(self, start = 0, stop = None):
+        # time of each sample in rows start to stop, from the sample rate if the board paced the samples,
+        # otherwise by spreading each block evenly up to the start of the next, as MicroController.Stream_Times does
+        stop = len(self) if stop is None else min(stop, len(self))
+        if self.meta['rate']:
+            t0 = self.blocks[0][0] if self.n_blocks() > 0 else 0.0
+            return t0 + numpy.arange(start, stop) / self.meta['rate']
+        if stop <= start:
+            return numpy.zeros(0)
+        # only the blocks that hold rows start to stop, and the block after them, are read
+        # the last block has no block after it and is spaced like the one before it, so that one is read instead
+        rows = numpy.asarray(self.blocks[:, 1])
+        first = max(0, numpy.searchsorted(rows, start, side = 'right') - 1)
+        last = numpy.searchsorted(rows, stop, side = 'left')
+        lo = first - 1 if last >= self.n_blocks() and first > 0 else first
+        blocks = numpy.asarray(self.blocks[lo:last + 1])
+        n = blocks[:, 2]
+        dt = numpy.diff(blocks[:, 0]) / n[:-1]
+        dt = numpy.append(dt, dt[-1] if len(dt) > 0 else 0.0)[first - lo:last - lo]
+        blocks = blocks[first - lo:last - lo]
+        n = n[first - lo:last - lo].astype(int)
+        row = numpy.arange(blocks[0, 1], blocks[0, 1] + n.sum())
+        t = numpy.repeat(blocks[:, 0], n) + numpy.repeat(dt, n) * (row - numpy.repeat(blocks[:, 1], n))
+        return t[start - int(blocks[0, 1]):stop - int(blocks[0, 1])]
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+def Recording_Test(n_blocks = 10, n_samples = 256, path = 'recording_test'):
+    # Record a stream from the simulated board and check that reading rows back a slice at a time
+    # gives the same counts and times as reading the whole recording, including slices inside the first and last blocks
+
+    FUNC_NAME = ".Recording_Test()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    try:
+        import Simulator
+        with MicroController.Session(rm = Simulator.ResourceManager(iface = 'AC_Read')) as dev:
+            with Recorder(path, mask = (1 << 1)) as rec:
+                rec.record(dev.stream(n_samples, (1 << 1), n_blocks, timestamps = True))
+        with Recording(path) as run:
+            n_rows = len(run)
+            assert n_rows == n_blocks * n_samples, "%(v1)d rows recorded, expected %(v2)d"%{"v1":n_rows, "v2":n_blocks * n_samples}
+            t_all = run.times()
+            assert numpy.all(numpy.diff(t_all) > 0.0), "Sample times do not increase"
+            last = n_rows - n_samples
+            for a, b in ((0, 3), (n_samples - 2, n_samples + 2), (last, last + 3), (last + 5, n_rows), (0, n_rows)):
+                assert numpy.allclose(run.times(a, b), t_all[a:b]), "times(%(v1)d, %(v2)d) differs from times()[%(v1)d:%(v2)d]"%{"v1":a, "v2":b}
+                assert numpy.array_equal(run.counts[a:b], numpy.asarray(run.counts)[a:b])
+        print("Recording of %(v1)d blocks read back consistently"%{"v1":n_blocks})
+        return True
+    except Exception as e:
+        print(ERR_STATEMENT)
+        print(e)
+        return False
@@ -0,0 +1,380 @@
+# This module lets the firmware in Measurement.py and the host code in MicroController.py be run against each other
+# on a PC without a board attached
+# The firmware runs unchanged in a separate Python process in which the CircuitPython modules
+# board, analogio, digitalio, supervisor, usb_cdc and microcontroller are replaced by the fakes defined here
+# The host talks to that process through an object that behaves like an open pyvisa resource
+#   dev = MicroController.Session(rm = Simulator.ResourceManager())
+# or, on Linux / macOS, through a pseudo-terminal that pyserial can open like a real port, see Pty_Board
+# The analog inputs can be driven by DC, sine and noise sources, e.g.
+#   rm = Simulator.ResourceManager(iface = 'AC_Read', signals = {'A2':[Simulator.Sine(1.0, 50.0, 1.5), Simulator.Noise(0.01)]})
+# and Current_Source gives the readback of the current source circuit for the constant current mode
+
+MOD_NAME_STR = "Simulator"
+
+import sys
+import os
+import types
+import builtins
+import threading
+import subprocess
+import time
+import gc
+import json
+import math
+import random
+
+DEFAULT_IFACE = 'Cuffe_Iface' # firmware method run by the simulated board
+RESOURCE_STR = 'SIM%(v1)d::INSTR' # address format of the simulated boards
+SIM_BOARD_ID = 'simulated_itsybitsy_m4' # board.board_id of the simulated board
+
+Vmax = 3.3 # max AO/AI value
+bit_scale = (64*1024)
+
+# DC level in volts seen at each analog input when no signal is given, A1 is wired back to A0 as in Measurement.IO_Simple
+Vin_levels = {'A2':1.2, 'A3':0.9, 'A4':0.85, 'A5':0.5}
+Vin_offset = 0.01 # offset between the A0 output and the A1 reading, O(10 mV) on the real board
+SIM_MEM_FREE = 128*1024 # free heap in bytes reported by the simulated board
+SIM_TEMPERATURE = 25.0 # cpu temperature of the simulated board in degrees C
+
+# ---- signal sources, a source is a dictionary so that it can be passed to the board process ----
+
+def DC(level):
+    # constant level in volts
+    return {'type':'dc', 'level':level}
+
+def Sine(amplitude, frequency, offset = 0.0, phase = 0.0):
+    # offset + amplitude * sin(2 pi frequency t + phase), frequency in Hz
+    return {'type':'sine', 'amplitude':amplitude, 'frequency':frequency, 'offset':offset, 'phase':phase}
+
+def Noise(sigma, level = 0.0):
+    # gaussian noise of standard deviation sigma about level, in volts
+    return {'type':'noise', 'sigma':sigma, 'level':level}
+
+def Follow(gain, offset = 0.0):
+    # offset + gain * the voltage on the A0 output, e.g. the readback of a circuit driven by Vout
+    return {'type':'follow', 'gain':gain, 'offset':offset}
+
+def Current_Source(gain_error = 0.9, level = 0.85):
+    # signals for the current source circuit of Measurement.Current_Source_Measurement
+    # Vin3 - Vin4 follows Vout through the circuit, gain_error scales the current from the ideal Vout * R2 / (R1 * R3)
+    # so that open-loop settings are off by a known amount and constant current mode has something to correct
+    R1 = (54.9/1000.0)
+    R2 = (10.3/1000.0)
+    Vscale = (5.0/3.0)
+    return {'A3':Follow(gain_error * R2 / (R1 * Vscale), level), 'A4':DC(level)}
+
+def Source_Value(source, t):
+    # value in volts of a source, or a list of sources added together, at time t in seconds
+    if isinstance(source, (list, tuple)):
+        return sum(Source_Value(s, t) for s in source)
+    elif source['type'] == 'sine':
+        return source['offset'] + source['amplitude'] * math.sin(2.0 * math.pi * source['frequency'] * t + source['phase'])
+    elif source['type'] == 'noise':
+        return random.gauss(source['level'], source['sigma'])
+    elif source['type'] == 'follow':
+        Vout = Fake_AnalogOut.outputs.get('A0')
+        return source['offset'] + source['gain'] * (Vout._value * Vmax / bit_scale if Vout is not None else 0.0)
+    else:
+        return source['level']
+
+# ---- board side, these run inside the simulated board process ----
+
+class Fake_Runtime(object):
+    # stands in for supervisor.runtime, serial input is collected by a thread reading stdin
+    def __init__(self):
+        self.lines = []
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def serial_bytes_available(self):
+        # wait briefly for input rather than spinning the CPU, returns as soon as a line arrives
+        if not self.lines:
+            self.ready.wait(0.001)
+        return len(self.lines) > 0
+
+    def put(self, line):
+        with self.lock:
+            self.lines.append(line)
+            self.ready.set()
+
+    def get(self):
+        while not self.lines:
+            self.ready.wait(0.1)
+        with self.lock:
+            line = self.lines.pop(0)
+            if not self.lines:
+                self.ready.clear()
+        return line
+
+class Fake_AnalogOut(object):
+    # stands in for analogio.AnalogOut, remembers the last value written in _value for the simulated inputs
+    # value is write-only, as on CircuitPython, so firmware that tries to read it back fails here too
+    outputs = {}
+
+    def __init__(self, pin):
+        self.pin = pin
+        self._value = 0
+        Fake_AnalogOut.outputs[pin] = self
+
+    def _set_value(self, value):
+        self._value = value
+
+    def _get_value(self):
+        raise AttributeError("AnalogOut.value is write-only")
+
+    value = property(_get_value, _set_value)
+
+    def deinit(self):
+        pass
+
+class Fake_AnalogIn(object):
+    # stands in for analogio.AnalogIn, value is a 16-bit count like the real thing
+    # the voltage comes from the source in signals for the pin, if there is one
+    # like the SAMD51 ADC only 12 bits of the 16-bit count are significant
+    signals = {}
+    start_time = time.monotonic()
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.reference_voltage = Vmax
+
+    @property
+    def value(self):
+        if self.pin in Fake_AnalogIn.signals:
+            volts = Source_Value(Fake_AnalogIn.signals[self.pin], time.monotonic() - Fake_AnalogIn.start_time)
+        elif self.pin == 'A1' and 'A0' in Fake_AnalogOut.outputs:
+            volts = Fake_AnalogOut.outputs['A0']._value * Vmax / bit_scale + Vin_offset
+        else:
+            volts = Vin_levels.get(self.pin, 0.0)
+        return max(0, min(bit_scale - 1, int(volts * bit_scale / Vmax))) & 0xFFF0
+
+    def deinit(self):
+        pass
+
+class Fake_DigitalInOut(object):
+    # stands in for digitalio.DigitalInOut
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = None
+        self.value = False
+
+class Fake_Console(object):
+    # stands in for usb_cdc.console, raw bytes go out on stdout after any pending text
+    def write(self, buf):
+        sys.stdout.flush()
+        sys.stdout.buffer.write(bytes(buf))
+        sys.stdout.buffer.flush()
+        return len(buf)
+
+def Install_Fakes(echo = True, signals = None):
+    # Put the fake CircuitPython modules in place so that Measurement can be imported
+    # input() is replaced by a version that reads from the runtime queue, and echoes like the CircuitPython REPL does
+    # signals maps pin names to the sources driving them
+
+    runtime = Fake_Runtime()
+    Fake_AnalogIn.signals = dict(signals) if signals else {}
+
+    board = types.ModuleType('board')
+    board.board_id = SIM_BOARD_ID
+    for name in ('A0', 'A1', 'A2', 'A3', 'A4', 'A5', 'D13'):
+        setattr(board, name, name)
+
+    analogio = types.ModuleType('analogio')
+    analogio.AnalogOut = Fake_AnalogOut
+    analogio.AnalogIn = Fake_AnalogIn
+
+    digitalio = types.ModuleType('digitalio')
+    digitalio.DigitalInOut = Fake_DigitalInOut
+    digitalio.Direction = types.SimpleNamespace(INPUT = 'input', OUTPUT = 'output')
+
+    supervisor = types.ModuleType('supervisor')
+    supervisor.runtime = runtime
+    supervisor.ticks_ms = lambda: int(time.monotonic() * 1000.0) & ((1 << 29) - 1) # wraps like the real one
+
+    usb_cdc = types.ModuleType('usb_cdc')
+    usb_cdc.console = Fake_Console()
+
+    microcontroller = types.ModuleType('microcontroller')
+    microcontroller.cpu = types.SimpleNamespace(temperature = SIM_TEMPERATURE, frequency = 120000000)
+
+    for module in (board, analogio, digitalio, supervisor, usb_cdc, microcontroller):
+        sys.modules[module.__name__] = module
+
+    # CircuitPython's gc reports the free heap, give the simulated board the RAM of an ItsyBitsy M4
+    if not hasattr(gc, 'mem_free'):
+        gc.mem_free = lambda: SIM_MEM_FREE
+
+    def fake_input(prompt = ''):
+        line = runtime.get()
+        if echo:
+            print(line)
+        return line
+    builtins.input = fake_input
+
+    def listen():
+        # pass each line from the host to the runtime, the board is switched off when the host goes away
+        for raw in sys.stdin.buffer:
+            runtime.put(raw.decode('ascii', 'replace').rstrip('\r\n'))
+        os._exit(0)
+    threading.Thread(target = listen, daemon = True).start()
+
+    return runtime
+
+def Run_Board(iface = DEFAULT_IFACE, echo = True, signals = None):
+    # Run one of the firmware methods in Measurement, e.g. Cuffe_Iface, AC_Read or AC_Max, as if it were running on the board
+
+    Install_Fakes(echo, signals)
+    import Measurement
+    getattr(Measurement, iface)()
+
+def Board_Command(iface = DEFAULT_IFACE, echo = True, signals = None):
+    # command line that starts a simulated board process, the settings are passed as JSON
+    config = {'iface':iface, 'echo':echo, 'signals':signals if signals else {}}
+    return [sys.executable, '-u', os.path.abspath(__file__), json.dumps(config)]
+
+# ---- host side, these run in the process that is talking to the simulated board ----
+
+class Simulated_Instrument(object):
+    # Behaves like an open pyvisa message based resource connected to a simulated board
+    # Only the parts of the pyvisa interface used by MicroController are provided
+
+    def __init__(self, address = RESOURCE_STR%{"v1":0}, iface = DEFAULT_IFACE, echo = True, signals = None):
+        self.resource_name = address
+        self.timeout = 2000 # milliseconds, as in pyvisa
+        self.read_termination = '\n'
+        self.write_termination = '\n'
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+        args = Board_Command(iface, echo, signals)
+        self.proc = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE, cwd = os.path.dirname(os.path.abspath(__file__)))
+        self.reader = threading.Thread(target = self._listen, daemon = True)
+        self.reader.start()
+
+    def __str__(self):
+        return "Simulated Instrument at %(v1)s"%{"v1":self.resource_name}
+
+    def _listen(self):
+        # collect everything the board sends into the buffer
+        chunk = self.proc.stdout.read1(4096)
+        while chunk:
+            with self.cond:
+                self.buf.extend(chunk)
+                self.cond.notify_all()
+            chunk = self.proc.stdout.read1(4096)
+
+    def _wait_for(self, ready):
+        # block until ready() is true or the timeout expires
+        end_time = time.monotonic() + self.timeout / 1000.0
+        with self.cond:
+            while not ready():
+                remaining = end_time - time.monotonic()
+                if remaining <= 0.0 or self.proc.poll() is not None:
+                    raise TimeoutError("Timeout expired before operation completed on " + self.resource_name)
+                self.cond.wait(remaining)
+
+    def write(self, message):
+        self.proc.stdin.write((message + self.write_termination).encode('ascii'))
+        self.proc.stdin.flush()
+        return len(message) + len(self.write_termination)
+
+    def write_raw(self, message):
+        self.proc.stdin.write(bytes(message))
+        self.proc.stdin.flush()
+        return len(message)
+
+    @property
+    def bytes_in_buffer(self):
+        # no. bytes received and not read yet, as on a pyvisa serial resource
+        with self.cond:
+            return len(self.buf)
+
+    def read_bytes(self, count):
+        self._wait_for(lambda: len(self.buf) >= count)
+        with self.cond:
+            data = bytes(self.buf[:count])
+            del self.buf[:count]
+        return data
+
+    def read(self):
+        term = self.read_termination.encode('ascii')
+        self._wait_for(lambda: self.buf.find(term) > -1)
+        with self.cond:
+            indx = self.buf.find(term)
+            data = bytes(self.buf[:indx])
+            del self.buf[:indx + len(term)]
+        return data.decode('ascii', 'replace')
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def clear(self):
+        with self.cond:
+            del self.buf[:]
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(1.0)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+class ResourceManager(object):
+    # Stands in for pyvisa.ResourceManager, lists and opens simulated boards
+
+    def __init__(self, n_devices = 1, iface = DEFAULT_IFACE, echo = True, signals = None):
+        self.n_devices = n_devices
+        self.iface = iface
+        self.echo = echo
+        self.signals = signals
+
+    def list_resources(self):
+        return tuple(RESOURCE_STR%{"v1":i} for i in range(0, self.n_devices, 1))
+
+    def open_resource(self, address, open_timeout = None, **kwargs):
+        return Simulated_Instrument(address, self.iface, self.echo, self.signals)
+
+    def close(self):
+        pass
+
+class Pty_Board(object):
+    # A simulated board attached to a pseudo-terminal, port is the device name to give to pyserial
+    #   board = Simulator.Pty_Board()
+    #   ser = serial.Serial(board.port, timeout = 1)
+    # The board process uses the master side of the pty, the host opens the slave side like any serial port
+    # Only available on Linux / macOS
+
+    def __init__(self, iface = DEFAULT_IFACE, echo = True, signals = None):
+
+        FUNC_NAME = ".Pty_Board.__init__()" # use this in exception handling messages
+        ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+        self.proc = None
+        self.port = None
+        try:
+            import pty
+            import tty
+            self.master, self.slave = pty.openpty()
+            tty.setraw(self.slave) # no line editing or local echo, the board does its own echo
+            self.port = os.ttyname(self.slave)
+            self.proc = subprocess.Popen(Board_Command(iface, echo, signals), stdin = self.master, stdout = self.master, cwd = os.path.dirname(os.path.abspath(__file__)))
+        except ImportError as e:
+            print(ERR_STATEMENT)
+            print("Pseudo-terminals are not available on this platform")
+            print(e)
+
+    def close(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+            os.close(self.master)
+            os.close(self.slave)
+            self.proc = None
+
+if __name__ == '__main__':
+    # Run as the simulated board, see Simulated_Instrument and Pty_Board
+    config = json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}
+    Run_Board(config.get('iface', DEFAULT_IFACE), config.get('echo', True), config.get('signals'))
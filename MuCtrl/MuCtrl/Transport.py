@@ -0,0 +1,331 @@
+# This module puts the different ways of reaching a board behind one interface
+# A transport behaves like the parts of an open pyvisa resource that MicroController uses, write, read, read_bytes, clear,
+# close and timeout in milliseconds, whether the bytes go through pyserial, pyvisa or a simulated board
+# Everything received is collected in a buffer on the PC, so lines and frames are cut out of it without a driver call per byte,
+# and read_nonblocking / in_waiting look at what has arrived without waiting for more
+#   link = Transport.Open('COM5', backend = 'serial', baud = 115200)
+#   link = Transport.Open('ASRL5::INSTR', backend = 'auto') # whichever of serial and VISA answers fastest
+#   dev = MicroController.Session('COM5', backend = 'serial')
+# The Arduino Micro works best over serial and the ItsyBitsy M4 over VISA, backend = 'auto' times both and keeps the faster one
+
+MOD_NAME_STR = "Transport"
+
+import os
+import re
+import math
+import time
+
+import serial # import the pySerial module pip install pyserial
+
+try:
+    import pyvisa
+except ImportError:
+    pyvisa = None # the VISA backend is not available, serial and loopback still are
+
+SERIAL = 'serial'
+VISA = 'visa'
+LOOPBACK = 'loopback' # a board running in Simulator, no hardware needed
+AUTO = 'auto' # the faster of SERIAL and VISA, see Fastest
+BACKENDS = (SERIAL, VISA, LOOPBACK)
+
+BAUD = 115200 # ignored by the native USB boards, which run at USB speed whatever the baud rate
+BUFFER_SIZE = 4096 # bytes asked for from the driver in one go, and the size requested for the driver buffers
+READ_TIMEOUT = 2000 # timeout for a single read in milliseconds, as in MicroController
+OPEN_TIMEOUT = 1000 * 60 # timeout for opening a VISA device in milliseconds
+WRITE_TIMEOUT = 1.0 # seconds a serial write may block
+
+# Round trip used to time a backend, the board answers queryModeStr + '1' with replyEndStr, must match Measurement
+PING_STR = 'q1'
+PING_END = '$'
+N_PINGS = 20 # round trips timed per backend
+
+latencies = {} # median round trip in seconds of each backend tried, keyed by (address, backend), so each device is timed once
+
+def Serial_Port(address):
+    # the serial port behind a VISA ASRL address, e.g. ASRL5::INSTR is COM5, ASRL/dev/ttyACM0::INSTR is /dev/ttyACM0
+    # anything else is taken to be a port name already
+
+    m = re.match(r'ASRL(.+)::INSTR$', address)
+    if m is None:
+        return address
+    return 'COM' + m.group(1) if m.group(1).isdigit() else m.group(1)
+
+def Visa_Address(port):
+    # the VISA ASRL address of a serial port, the reverse of Serial_Port, VISA addresses are returned unchanged
+
+    if '::' in port:
+        return port
+    m = re.match(r'COM(\d+)$', port)
+    return 'ASRL' + (m.group(1) if m else port) + '::INSTR'
+
+class Transport(object):
+    # The buffering and line handling shared by all of the backends
+    # A backend provides _send(data), _recv(max_bytes, timeout) returning whatever arrives within timeout seconds, possibly nothing,
+    # _flush() to drop anything held by the driver and _close()
+
+    backend = None
+
+    def __init__(self, address, timeout = READ_TIMEOUT, buffer_size = BUFFER_SIZE):
+        self.resource_name = address
+        self.timeout = timeout # milliseconds
+        self.buffer_size = buffer_size
+        self.read_termination = '\n'
+        self.write_termination = '\n'
+        self.buf = bytearray()
+
+    def __str__(self):
+        return "%(v1)s transport to %(v2)s"%{"v1":self.backend, "v2":self.resource_name}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fill(self, ready):
+        # receive into the buffer until ready() is true, raises TimeoutError if that takes longer than self.timeout
+        end_time = time.monotonic() + self.timeout / 1000.0
+        while not ready():
+            remaining = end_time - time.monotonic()
+            if remaining <= 0.0:
+                raise TimeoutError("Timeout expired before operation completed on " + self.resource_name)
+            self.buf.extend(self._recv(self.buffer_size, remaining))
+
+    def _poll(self):
+        # move whatever the driver already holds into the buffer without waiting
+        data = self._recv(self.buffer_size, 0.0)
+        while data:
+            self.buf.extend(data)
+            data = self._recv(self.buffer_size, 0.0)
+
+    def write(self, message):
+        # send a command, the write termination is added
+        data = (message + self.write_termination).encode('ascii')
+        self._send(data)
+        return len(data)
+
+    def write_raw(self, data):
+        self._send(bytes(data))
+        return len(data)
+
+    def read(self):
+        # the next line, without its termination, waits up to self.timeout for it
+        term = self.read_termination.encode('ascii')
+        self._fill(lambda: self.buf.find(term) > -1)
+        indx = self.buf.find(term)
+        data = bytes(self.buf[:indx])
+        del self.buf[:indx + len(term)]
+        return data.decode('ascii', 'replace')
+
+    def read_bytes(self, count):
+        # exactly count bytes, waits up to self.timeout for them
+        self._fill(lambda: len(self.buf) >= count)
+        data = bytes(self.buf[:count])
+        del self.buf[:count]
+        return data
+
+    def peek(self, count = 1):
+        # the next count bytes without taking them off the buffer, waits up to self.timeout for them
+        self._fill(lambda: len(self.buf) >= count)
+        return bytes(self.buf[:count])
+
+    def read_nonblocking(self):
+        # the next line if all of it has arrived, otherwise None, never waits
+        self._poll()
+        term = self.read_termination.encode('ascii')
+        if self.buf.find(term) > -1:
+            return self.read()
+        return None
+
+    def read_available(self):
+        # every byte that has arrived so far, possibly none, never waits
+        self._poll()
+        data = bytes(self.buf)
+        del self.buf[:]
+        return data
+
+    @property
+    def in_waiting(self):
+        # no. bytes that have arrived and not been read yet
+        self._poll()
+        return len(self.buf)
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def clear(self):
+        # drop everything received and not yet read
+        del self.buf[:]
+        self._flush()
+
+    def close(self):
+        self._close()
+
+class Serial_Transport(Transport):
+    # A board on a serial port through pyserial, e.g. the Arduino Micro
+
+    backend = SERIAL
+
+    def __init__(self, port, timeout = READ_TIMEOUT, baud = BAUD, buffer_size = BUFFER_SIZE):
+        Transport.__init__(self, Serial_Port(port), timeout, buffer_size)
+        self.ser = serial.Serial(self.resource_name, baudrate = baud, timeout = 0, write_timeout = WRITE_TIMEOUT)
+        if hasattr(self.ser, 'set_buffer_size'):
+            self.ser.set_buffer_size(rx_size = buffer_size, tx_size = buffer_size) # only available on Windows
+
+    def _send(self, data):
+        self.ser.write(data)
+
+    def _recv(self, max_bytes, timeout):
+        n = self.ser.in_waiting
+        if n > 0 or timeout <= 0.0:
+            return self.ser.read(min(n, max_bytes)) if n > 0 else b''
+        # block for the first byte only, then take whatever else has come in with it
+        self.ser.timeout = timeout
+        try:
+            data = self.ser.read(1)
+        finally:
+            self.ser.timeout = 0
+        n = min(self.ser.in_waiting, max_bytes - len(data))
+        return data + self.ser.read(n) if data and n > 0 else data
+
+    def _flush(self):
+        self.ser.reset_input_buffer()
+
+    def _close(self):
+        self.ser.close()
+
+class Visa_Transport(Transport):
+    # A board opened as a VISA resource through pyvisa, e.g. the ItsyBitsy M4
+    # rm is the resource manager to open it with, a new pyvisa.ResourceManager() if none is given
+
+    backend = VISA
+
+    def __init__(self, address, timeout = READ_TIMEOUT, baud = BAUD, buffer_size = BUFFER_SIZE, rm = None):
+        Transport.__init__(self, Visa_Address(address), timeout, buffer_size)
+        if rm is None and pyvisa is None:
+            raise Exception("pyvisa is needed for the " + VISA + " backend, pip install pyvisa")
+        self.rm = rm if rm is not None else pyvisa.ResourceManager()
+        self.instr = self.rm.open_resource(self.resource_name, open_timeout = OPEN_TIMEOUT)
+        self.visa_timeout = None
+        if hasattr(self.instr, 'baud_rate'):
+            self.instr.baud_rate = baud
+        if hasattr(self.instr, 'visalib'):
+            try:
+                self.instr.visalib.set_buffer(self.instr.session, pyvisa.constants.BufferType.io_in | pyvisa.constants.BufferType.io_out, buffer_size)
+            except (pyvisa.errors.VisaIOError, NotImplementedError):
+                pass # not every VISA library or resource lets the buffers be sized
+
+    def _send(self, data):
+        self.instr.write_raw(data)
+
+    def _recv(self, max_bytes, timeout):
+        # bytes_in_buffer is only available on serial (ASRL) resources, others are read a byte at a time as they arrive
+        n = getattr(self.instr, 'bytes_in_buffer', 0)
+        if n > 0:
+            return self.instr.read_bytes(min(n, max_bytes))
+        if timeout <= 0.0:
+            return b''
+        ms = max(1, int(math.ceil(1000.0 * timeout)))
+        if ms != self.visa_timeout:
+            self.instr.timeout = ms
+            self.visa_timeout = ms
+        try:
+            data = self.instr.read_bytes(1)
+        except TimeoutError:
+            return b''
+        except Exception as e:
+            if pyvisa is None or not isinstance(e, pyvisa.errors.VisaIOError) or e.error_code != pyvisa.constants.StatusCode.error_timeout:
+                raise
+            return b''
+        n = min(getattr(self.instr, 'bytes_in_buffer', 0), max_bytes - 1)
+        return data + self.instr.read_bytes(n) if n > 0 else data
+
+    def _flush(self):
+        self.instr.clear()
+
+    def _close(self):
+        self.instr.close()
+
+class Loopback_Transport(Visa_Transport):
+    # A board running the firmware in Simulator, for trying out and timing the host code without hardware
+    # iface, echo and signals are passed on to Simulator.ResourceManager
+
+    backend = LOOPBACK
+
+    def __init__(self, address = None, timeout = READ_TIMEOUT, baud = BAUD, buffer_size = BUFFER_SIZE, rm = None, iface = None, echo = True, signals = None):
+        import Simulator
+        if rm is None:
+            rm = Simulator.ResourceManager(iface = iface if iface is not None else Simulator.DEFAULT_IFACE, echo = echo, signals = signals)
+        Visa_Transport.__init__(self, address if address is not None else rm.list_resources()[0], timeout, baud, buffer_size, rm)
+
+def List(backend = VISA, rm = None):
+    # addresses of the devices that backend can reach
+
+    if backend == SERIAL:
+        from serial.tools import list_ports
+        return tuple(p.device for p in list_ports.comports())
+    elif backend == LOOPBACK:
+        import Simulator
+        return (rm if rm is not None else Simulator.ResourceManager()).list_resources()
+    elif rm is not None or pyvisa is not None:
+        return (rm if rm is not None else pyvisa.ResourceManager()).list_resources()
+    return ()
+
+def Benchmark(link, n_pings = N_PINGS):
+    # round-trip times in seconds of n_pings PING_STR commands on an open transport, after one untimed round trip that
+    # also clears out anything left over from before, the board is left in query mode
+
+    times = []
+    for i in range(0, n_pings + 1, 1):
+        start_time = time.perf_counter()
+        link.write(PING_STR)
+        while link.read().strip() != PING_END:
+            pass
+        if i > 0:
+            times.append(time.perf_counter() - start_time)
+    return times
+
+def Fastest(address, backends = (SERIAL, VISA), timeout = READ_TIMEOUT, baud = BAUD, buffer_size = BUFFER_SIZE, rm = None, n_pings = N_PINGS):
+    # time the round trip to the device at address over each of backends and return the fastest one that answers
+    # the median time of each is kept in latencies so each device is only timed once, None for a backend that did not answer
+
+    FUNC_NAME = ".Fastest()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    for backend in backends:
+        key = (Serial_Port(address), backend)
+        if key not in latencies:
+            link = None
+            try:
+                link = Open(address, backend, timeout, baud, buffer_size, rm)
+                latencies[key] = float(sorted(Benchmark(link, n_pings))[n_pings // 2])
+            except Exception as e:
+                print(ERR_STATEMENT)
+                print(backend, "not available for", address)
+                print(e)
+                latencies[key] = None
+            finally:
+                if link is not None:
+                    link.close()
+    timed = [(latencies[(Serial_Port(address), b)], b) for b in backends if latencies[(Serial_Port(address), b)] is not None]
+    return min(timed)[1] if timed else None
+
+def Open(address, backend = VISA, timeout = READ_TIMEOUT, baud = BAUD, buffer_size = BUFFER_SIZE, rm = None):
+    # open a transport to the device at address, a VISA address or a serial port name, either is accepted by every backend
+    # backend = AUTO picks the faster of SERIAL and VISA, see Fastest
+    # rm is the resource manager for VISA, or a Simulator.ResourceManager for LOOPBACK
+
+    FUNC_NAME = ".Open()" # use this in exception handling messages
+    ERR_STATEMENT = "Error: " + MOD_NAME_STR + FUNC_NAME
+
+    if backend == AUTO:
+        backend = Fastest(address, timeout = timeout, baud = baud, buffer_size = buffer_size, rm = rm)
+    if backend == SERIAL:
+        return Serial_Transport(address, timeout, baud, buffer_size)
+    elif backend == VISA:
+        return Visa_Transport(address, timeout, baud, buffer_size, rm)
+    elif backend == LOOPBACK:
+        return Loopback_Transport(address, timeout, baud, buffer_size, rm)
+    ERR_STATEMENT = ERR_STATEMENT + "\nNo backend available for " + str(address) + ", backend must be one of " + str(BACKENDS + (AUTO,))
+    raise Exception(ERR_STATEMENT)